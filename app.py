@@ -1,47 +1,168 @@
-from flask import Flask, render_template, flash, redirect, url_for, session, request, logging, send_from_directory
-from data import getPrintJobs, getPrintJob, releaseJob, cancelJob, getPrinterList, getLocations
+from flask import Flask, render_template, stream_template, flash, redirect, url_for, session, request, logging, send_from_directory, jsonify, Response
+from flask_caching import Cache
+from data import getPrintJobs, getCompletedJobs, getPrintJob, releaseJob, cancelJob, bulkJobAction, getCountStats, getUsageReport, getPrinterList, getLocations, \
+                 getJobState, getJobChanges, getJobList, getHistoryVersion, jobEventHub
 #from wtforms import Form, StringField, TextAreaField, PasswordField, validators
 from functools import wraps
 from datetime import datetime, timedelta, date, timezone
+import hashlib
+import json
 import os
+import time
 import config
 import getpass
-from db import initDB
+from db import initDB, isReadOnly
+from maintenance import startMaintenance
+from assets import AssetTable, cdnUrl, vendorAssets
+from jobrecord import JobRecord, formatTime, stateName, queueName
+import gzip
+import zlib
 
 app = Flask(__name__)
 app.secret_key=config.SECRET_KEY
-initDB()
 
-def is_number( s ):
+# The page count service creates, migrates and prunes wpr.db when it owns it
+if not isReadOnly():
+    initDB()
+    startMaintenance()
+
+# Short lived cache for views built from CUPS.  Any CACHE_* setting in config.py is passed
+# to Flask-Caching, e.g. CACHE_TYPE = 'FileSystemCache' and CACHE_DIR to share it between
+# gunicorn workers or 'RedisCache' with CACHE_REDIS_URL for a local cache server.
+cacheConfig = { 'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 30 }
+cacheConfig.update( { k: getattr( config, k ) for k in dir( config ) if k.startswith( 'CACHE_' ) } )
+cache = Cache( app, config=cacheConfig )
+
+@cache.memoize( timeout=getattr( config, 'LOCATION_CACHE_TTL', 30 ) )
+def cachedLocations():
+    return getLocations()
+
+@cache.memoize( timeout=getattr( config, 'PRINTER_LIST_CACHE_TTL', 10 ) )
+def cachedPrinterList():
+    return getPrinterList()
+
+def jobsCacheKey( version, *args ):
+    """Key for a rendered job list.  version is the job snapshot version, which lives
+       in a file every worker reads, so a release or cancel in any worker changes the
+       key in all of them even with a per worker SimpleCache.
+    """
+    return 'jobs/' + str( version ) + '/' + str( session.get( 'location', 'all' ) ) + '/' + '/'.join( str( v ) for v in args )
+
+def invalidateJobCache():
+    """Drop views that a release or cancel changes.  Rendered job lists go stale by
+       themselves once the job snapshot is rebuilt.
+    """
+    cache.delete_memoized( cachedPrinterList )
+
+# Static files are linked by content hashed names so browsers can keep them forever
+assetTable = AssetTable( app.static_folder )
+
+# 'local' serves third party files from static/vendor and 'cdn' links to the CDN
+vendorSource = getattr( config, 'VENDOR_ASSETS', 'local' )
+
+@app.context_processor
+def asset_processor():
+    def asset_url( filename ):
+        """URL of a static file under its hashed name.  Vendored files come from the
+           CDN with VENDOR_ASSETS = 'cdn', or with a logged warning if vendor.py
+           hasn't downloaded them.
+        """
+        if filename in vendorAssets and vendorSource == 'cdn':
+            return cdnUrl( filename, expected=False )
+
+        hashed = assetTable.name( filename )
+
+        if hashed == None:
+            if filename in vendorAssets:
+                return cdnUrl( filename )
+
+            return url_for( 'static', filename=filename )
+
+        return url_for( 'asset', filename=hashed )
+
+    return dict( asset_url = asset_url )
+
+@app.route( '/assets/<path:filename>' )
+def asset( filename ):
+    static, current = assetTable.resolve( filename )
+
+    response = send_from_directory( app.static_folder, static, max_age=31536000 if current else None )
+
+    if current:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+
+    return response
+
+def gzipStream( chunks ):
+    """Compress a streamed response without holding it back for long.  Templates
+       yield many tiny strings, so they are gathered into GZIP_STREAM_BUFFER bytes
+       before each flush.  Rows still reach the browser a batch at a time.
+    """
+    compressor = zlib.compressobj( 6, zlib.DEFLATED, 31 )
+    limit = getattr( config, 'GZIP_STREAM_BUFFER', 8192 )
+    buffer = []
+    buffered = 0
+
     try:
-        float( s )
-        return True
-    except:
-        return False
+        for chunk in chunks:
+            if isinstance( chunk, str ):
+                chunk = chunk.encode( 'utf-8' )
 
-@app.template_filter()
-def datetimefilter( value, format='%Y/%m/%d %I:%M %p' ):
-    if is_number( value ):
-        ts = int( value )
+            buffer.append( chunk )
+            buffered += len( chunk )
 
-        return datetime.fromtimestamp(ts).strftime( format )
+            if buffered >= limit:
+                yield compressor.compress( b''.join( buffer ) ) + compressor.flush( zlib.Z_SYNC_FLUSH )
+
+                buffer = []
+                buffered = 0
+
+        yield compressor.compress( b''.join( buffer ) ) + compressor.flush()
+    finally:
+        if hasattr( chunks, 'close' ):
+            chunks.close()
+
+# Responses worth compressing: pages and the stylesheets, scripts and icons they load
+compressedTypes = ( 'text/html', 'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml' )
+
+@app.after_request
+def compress( response ):
+    """gzip pages and static text files for clients that accept it"""
+
+    if response.mimetype not in compressedTypes or response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+
+    response.vary.add( 'Accept-Encoding' )
+
+    if not request.accept_encodings['gzip']:
+        return response
+
+    if response.is_streamed:
+        response.response = gzipStream( response.response )
+        response.headers.pop( 'Content-Length', None )
     else:
-        return value
+        # Static files are sent straight from disk unless we read them here
+        response.direct_passthrough = False
+        body = response.get_data()
+
+        if len( body ) < getattr( config, 'GZIP_MIN_SIZE', 500 ):
+            return response
+
+        response.set_data( gzip.compress( body, 6 ) )
+
+    response.headers['Content-Encoding'] = 'gzip'
+
+    return response
+
+@app.template_filter()
+def datetimefilter( value, format='%Y/%m/%d %I:%M %p' ):
+    return formatTime( value, format )
 
 app.jinja_env.filters['datetimefilter'] = datetimefilter
 
 @app.template_filter()
 def jobstate( value ):
-    states = {  3:'Pending',
-                4:'Held', 
-                5:'Printing',
-                6:'Stopped',
-                7:'Canceled',
-                8:'Aborted: Error',
-                9:'Completed'
-             }
-    
-    return states.get( value, 'Unknown' )
+    return stateName( value )
 
 app.jinja_env.filters['jobstate'] = jobstate
 
@@ -58,13 +179,64 @@ app.jinja_env.filters['printerstate'] = printerstate
 
 @app.template_filter()
 def queuefromuri(value):
-    offset = value.rfind( '/' )
-    name = value[offset + 1:]
-
-    return name
+    return queueName( value )
 
 app.jinja_env.filters['queuefromuri'] = queuefromuri
 
+# Job fields sent by the JSON API.  Enough to draw the job tables.
+apiJobFields = ['job-id',
+                'job-name',
+                'job-state',
+                'job-printer-uri',
+                'job-printer-location',
+                'job-originating-user-name',
+                'job-k-octets',
+                'time-at-creation',
+                'time-at-completed',
+                'copies',
+                'page-count',
+                'page-count-pending',
+                'page-count-failed',
+                'printed-pages'
+               ]
+
+def compactJob( job ):
+    return { k: job[k] for k in apiJobFields if k in job }
+
+def listedJob( job, records=None ):
+    """An active job for jobs.js.  Adds the display strings and sort keys of its
+       JobRecord so rows patched in match the rendered ones and sort the same way.
+       records maps job ids to JobRecords already built for this version.
+    """
+    record = ( records or {} ).get( job['job-id'] ) or JobRecord( job )
+
+    result = compactJob( job )
+    result['display'] = record.display()
+    result['keys'] = record.columnKeys()
+
+    return result
+
+def stateTag( version, *filters ):
+    """ETag for one version of some state as seen through the given filters"""
+    return str( version ) + '-' + hashlib.sha1( repr( filters ).encode() ).hexdigest()[:12]
+
+def notModified( etag ):
+    """A 304 response if the client already has etag, otherwise None"""
+    if request.if_none_match.contains( etag ):
+        response = app.response_class( status=304 )
+        response.set_etag( etag )
+
+        return response
+
+    return None
+
+def taggedJson( etag, **kwargs ):
+    response = jsonify( **kwargs )
+    response.set_etag( etag )
+    response.headers['Cache-Control'] = 'no-cache'
+
+    return response
+
 # Check if user logged in
 def is_logged_in(f):
     @wraps(f)
@@ -84,7 +256,7 @@ def favicon():
 @app.route( '/' )
 def index():
     try:
-        Locations = getLocations()
+        Locations = cachedLocations()
     except Exception as e:
         return render_template( 'home.html', error = repr(e) )
 
@@ -100,11 +272,12 @@ def index():
 @app.route( '/about' )
 def about():
     try:
-        Locations = getLocations()
+        Locations = cachedLocations()
+        CountStats = getCountStats()
     except Exception as e:
         return render_template( 'about.html', error = repr(e) )
 
-    return render_template( 'about.html', locations = Locations )
+    return render_template( 'about.html', locations = Locations, count_stats = CountStats )
 
 @app.route( '/jobs' )
 @is_logged_in
@@ -136,33 +309,90 @@ def jobs():
     else:
         next_mode = 'off'
 
+    # The page asks /api/jobs for changes since this version
+    try:
+        version = getJobState()['version']
+    except Exception as e:
+        return render_template( 'jobs.html', error = repr(e), advanced = 0 )
+
+    # Serve a recent render of this version for this location and view unless there
+    # are messages to show
+    key = jobsCacheKey( version, advanced, sort, sort_order )
+    flashes = '_flashes' in session
+
+    if not flashes:
+        page = cache.get( key )
+
+        if page != None:
+            return page
+
     # Go ahead and get the print jobs
     try:
         Jobs = getPrintJobs( 'not-completed', sort, sort_order )
-        Locations = getLocations()
+        Locations = cachedLocations()
     except Exception as e:
-        return render_template( 'jobs.html', error = repr(e) )
+        return render_template( 'jobs.html', error = repr(e), advanced = 0 )
 
-    if Jobs:
-        Location = session.get('location', 'all')
+    Location = session.get('location', 'all')
 
-        if Location == 'all':
-            filtered_jobs = Jobs
-        else:
-            filtered_jobs = list( filter( lambda d: d['job-printer-location'] == Location, Jobs ) )
+    if Location == 'all':
+        filtered_jobs = Jobs
+    else:
+        filtered_jobs = [ job for job in Jobs if job.location == Location ]
+
+    # An empty list still gets the table so jobs.js can add rows as they arrive
+    page = render_template( 'jobs.html', jobs = filtered_jobs, advanced = advanced, next_mode = next_mode, sort = sort, sort_order = sort_order, sort_order_next = sort_order_next, locations = Locations, version = version,
+                            events = getattr( config, 'JOB_EVENTS', True ) )
+
+    if not flashes:
+        cache.set( key, page, timeout=getattr( config, 'JOBS_CACHE_TTL', 5 ) )
+
+    return page
+
+def completedArgs( max_size=1000 ):
+    """Sort, filters, date range and page of a job history request"""
+
+    # Keep track of sort order
+    sort = request.args.get('sort', 'time-at-completed')
+    sort_order = request.args.get('order', 'desc')
+
+    filters = request.args.get('filters', 'none')
+    daterange = request.args.get('daterange')
+
+    # Paging.  page starts at 1.
+    page = max( request.args.get('page', 1, type=int), 1 )
+    page_size = min( max( request.args.get('size', getattr( config, 'COMPLETED_PAGE_SIZE', 100 ), type=int), 1 ), max_size )
+
+    if daterange == None:
+        # No date range provided so lets build one that spans 30 days
+        startdate = datetime.now() - timedelta(days=30)
+        enddate = datetime.now() + timedelta(days=1)
+        daterange = startdate.strftime('%m/%d/%Y') + ' - ' + datetime.now().strftime('%m/%d/%Y')
+    else:
+        # We have a date range so lets parse it
+        str_startdate,str_enddate = daterange.split(' - ')
+
+        startdate = datetime.strptime(str_startdate, '%m/%d/%Y')
+        enddate = datetime.strptime(str_enddate, '%m/%d/%Y') + timedelta(days=1)
 
-        return render_template( 'jobs.html', jobs = filtered_jobs, advanced = advanced, next_mode = next_mode, sort = sort, sort_order = sort_order, sort_order_next = sort_order_next, locations = Locations )
+    if filters == 'none':
+        # No filters so we will just limit on date range
+        StateList = None
     else:
-        msg = 'No Print Jobs in Queue'
-        return render_template( 'jobs.html', msg = msg, advanced = advanced, next_mode = next_mode, locations = Locations )
+        # We have filters so filter and limit on date range
+        StateList = [9] # == completed
+
+    return sort, sort_order, filters, daterange, startdate, enddate, StateList, page, page_size
 
 @app.route( '/jobscompleted' )
 @is_logged_in
 def jobscompleted():
 
-    # Keep track of sort order
-    sort = request.args.get('sort', 'time-at-completed')
-    sort_order = request.args.get('order', 'desc')
+    # Streamed pages are sent a row at a time so they can be much bigger
+    stream = getattr( config, 'COMPLETED_STREAM', True )
+    max_size = getattr( config, 'COMPLETED_MAX_PAGE_SIZE', 10000 ) if stream else 1000
+
+    sort, sort_order, filters, daterange, startdate, enddate, StateList, page, page_size = completedArgs( max_size )
 
     # Used to toggle sort order in template
     if sort_order == 'asc':
@@ -170,47 +400,209 @@ def jobscompleted():
     else:
         sort_order_next = 'asc'
 
+    Location = session.get('location', 'all')
+
     try:
-        Jobs = getPrintJobs( 'completed', sort, sort_order )
-        Locations = getLocations()
+        Jobs, total = getCompletedJobs( startdate.timestamp(), enddate.timestamp(), Location, StateList, sort, sort_order, ( page - 1 ) * page_size, page_size, stream )
+        Locations = cachedLocations()
     except Exception as e:
         return render_template( 'jobscompleted.html', error = repr(e) )
 
-    if Jobs:
-        filters = request.args.get('filters', 'none')
-        daterange = request.args.get('daterange')
-
-        Location = session.get('location', 'all')
+    if total:
+        pages = ( total + page_size - 1 ) // page_size
 
-        if Location == 'all':
-            location_jobs = Jobs
-        else:
-            location_jobs = list( filter( lambda d: d['job-printer-location'] == Location, Jobs ) )
+        if page > pages:
+            # Past the end so show the last page
+            page = pages
+            Jobs, total = getCompletedJobs( startdate.timestamp(), enddate.timestamp(), Location, StateList, sort, sort_order, ( page - 1 ) * page_size, page_size, stream )
 
-        if daterange == None:
-            # No date range provided so lets build one that spans 30 days
-            startdate = datetime.now() - timedelta(days=30)
-            enddate = datetime.now() + timedelta(days=1)
-            daterange = startdate.strftime('%m/%d/%Y') + ' - ' + datetime.now().strftime('%m/%d/%Y')
-        else:
-            # We have a date range so lets parse it
-            str_startdate,str_enddate = daterange.split(' - ')
+        first_row = ( page - 1 ) * page_size + 1
 
-            startdate = datetime.strptime(str_startdate, '%m/%d/%Y')
-            enddate = datetime.strptime(str_enddate, '%m/%d/%Y') + timedelta(days=1)
+        # Rows go out as the database produces them rather than after the whole page is built
+        render = stream_template if stream else render_template
 
-        if filters == 'none':
-            # No filters so we will just limit on date range
-            filtered_jobs = list( filter( lambda d: startdate < datetime.fromtimestamp( d['time-at-completed'] ) < enddate, location_jobs ) )
-            return render_template( 'jobscompleted.html', jobs = filtered_jobs, filters = filters, daterange = daterange, sort = sort, sort_order = sort_order, sort_order_next = sort_order_next, locations = Locations )
-        else:
-            # We have filters so filter and limit on date range
-            StateList = [9] # == completed
-            filtered_jobs = list( filter( lambda d: ( d['job-state'] in StateList ) and ( startdate < datetime.fromtimestamp( d['time-at-completed'] ) < enddate ), location_jobs ) )
-            return render_template( 'jobscompleted.html', jobs = filtered_jobs, filters = filters, daterange = daterange, sort = sort, sort_order = sort_order, sort_order_next = sort_order_next, locations = Locations )
+        return render( 'jobscompleted.html', jobs = Jobs, filters = filters, daterange = daterange, sort = sort, sort_order = sort_order, sort_order_next = sort_order_next, locations = Locations,
+                       page = page, pages = pages, page_size = page_size, total = total, first_row = first_row, last_row = min( first_row + page_size - 1, total ) )
     else:
         msg = 'No Print Jobs History'
-        return render_template( 'jobscompleted.html', msg = msg, locations = Locations )
+        return render_template( 'jobscompleted.html', msg = msg, locations = Locations, filters = filters, daterange = daterange, sort = sort, sort_order = sort_order, sort_order_next = sort_order_next, page_size = page_size )
+
+@app.route( '/api/jobs' )
+@is_logged_in
+def api_jobs():
+    """Active jobs at this terminal's location as JSON.
+
+       The ETag follows the job list version so an unchanged list costs a 304.
+       With since=<version> only jobs added or changed after that version and the
+       ids of removed jobs are sent, unless since is too old and full is true.
+    """
+
+    Location = session.get('location', 'all')
+    since = request.args.get('since', type=int)
+
+    try:
+        State = getJobState()
+    except Exception as e:
+        return jsonify( error = repr(e) ), 500
+
+    etag = stateTag( State['version'], Location )
+
+    response = notModified( etag )
+    if response:
+        return response
+
+    changes = None if since == None else getJobChanges( State, since, Location )
+    records = getJobList( State ).byId
+
+    if changes == None:
+        jobs = [ listedJob( v, records ) for v in State['jobs'] if Location == 'all' or v['job-printer-location'] == Location ]
+
+        return taggedJson( etag, version = State['version'], full = True, jobs = jobs )
+
+    return taggedJson( etag, version = State['version'], full = False,
+                       added = [ listedJob( v, records ) for v in changes['added'] ],
+                       changed = [ listedJob( v, records ) for v in changes['changed'] ],
+                       removed = changes['removed'] )
+
+def sseEvent( event, data, version=None ):
+    message = 'event: ' + event + '\ndata: ' + json.dumps( data ) + '\n\n'
+
+    if version != None:
+        # Lets the browser resume from here after a reconnect
+        message = 'id: ' + str( version ) + '\n' + message
+
+    return message
+
+@app.route( '/api/jobs/events' )
+@is_logged_in
+def api_job_events():
+    """Server-sent events for active jobs at this terminal's location.
+
+       job-added and job-state-changed carry the job, job-removed its id.  reset
+       carries the full list when the changes can't be worked out.  The stream
+       starts with the changes since the since argument or Last-Event-ID and ends
+       after JOB_EVENT_STREAM_SECONDS so the browser reconnects to a fresh one.
+    """
+
+    if not getattr( config, 'JOB_EVENTS', True ):
+        return jsonify( error = 'Job events are turned off' ), 404
+
+    Location = session.get('location', 'all')
+    since = request.headers.get( 'Last-Event-ID', type=int )
+    if since == None:
+        since = request.args.get('since', type=int)
+    lifetime = getattr( config, 'JOB_EVENT_STREAM_SECONDS', 300 )
+
+    def reset( State ):
+        records = getJobList( State ).byId
+        jobs = [ listedJob( v, records ) for v in State['jobs'] if Location == 'all' or v['job-printer-location'] == Location ]
+
+        return sseEvent( 'reset', { 'version': State['version'], 'jobs': jobs }, State['version'] )
+
+    def stream():
+        subscriber = jobEventHub.subscribe( Location )
+
+        try:
+            yield 'retry: 5000\n\n'
+
+            # Catch up.  Anything that also arrives as an event is just applied twice.
+            try:
+                State = getJobState()
+            except Exception as e:
+                yield sseEvent( 'error', { 'error': repr(e) } )
+                return
+
+            changes = None if since == None else getJobChanges( State, since, Location )
+
+            if changes == None:
+                yield reset( State )
+            else:
+                records = getJobList( State ).byId
+
+                for v in changes['added']:
+                    yield sseEvent( 'job-added', listedJob( v, records ), State['version'] )
+                for v in changes['changed']:
+                    yield sseEvent( 'job-state-changed', listedJob( v, records ), State['version'] )
+                for job_id in changes['removed']:
+                    yield sseEvent( 'job-removed', job_id, State['version'] )
+
+            deadline = time.monotonic() + lifetime
+
+            while time.monotonic() < deadline:
+                events = subscriber.get( timeout=max( min( 15, deadline - time.monotonic() ), 0 ) )
+
+                if not events:
+                    # Keeps proxies from closing the connection and finds clients that have gone
+                    yield ': keepalive\n\n'
+
+                for event, data, version in events:
+                    if event == 'reset':
+                        yield reset( getJobState() )
+                    elif event == 'job-removed':
+                        yield sseEvent( event, data, version )
+                    else:
+                        yield sseEvent( event, listedJob( data ), version )
+        finally:
+            jobEventHub.unsubscribe( subscriber )
+
+    return Response( stream(), mimetype='text/event-stream', headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' } )
+
+@app.route( '/api/jobscompleted' )
+@is_logged_in
+def api_jobscompleted():
+    """One page of job history as JSON.  Takes the same arguments as /jobscompleted.
+       The ETag follows the history archive version.
+    """
+
+    sort, sort_order, filters, daterange, startdate, enddate, StateList, page, page_size = completedArgs()
+    Location = session.get('location', 'all')
+
+    try:
+        etag = stateTag( getHistoryVersion(), Location, sort, sort_order, filters, daterange, page, page_size )
+
+        response = notModified( etag )
+        if response:
+            return response
+
+        Jobs, total = getCompletedJobs( startdate.timestamp(), enddate.timestamp(), Location, StateList, sort, sort_order, ( page - 1 ) * page_size, page_size )
+    except Exception as e:
+        return jsonify( error = repr(e) ), 500
+
+    return taggedJson( etag, total = total, page = page, page_size = page_size, jobs = [ compactJob( v ) for v in Jobs ] )
+
+@app.route( '/reports' )
+@is_logged_in
+def reports():
+
+    period = request.args.get('period', 'day')
+    group = request.args.get('group', 'location')
+    daterange = request.args.get('daterange')
+
+    if daterange == None:
+        # No date range provided so lets build one that spans 30 days
+        startdate = datetime.now() - timedelta(days=30)
+        enddate = datetime.now()
+        daterange = startdate.strftime('%m/%d/%Y') + ' - ' + enddate.strftime('%m/%d/%Y')
+    else:
+        # We have a date range so lets parse it
+        str_startdate,str_enddate = daterange.split(' - ')
+
+        startdate = datetime.strptime(str_startdate, '%m/%d/%Y')
+        enddate = datetime.strptime(str_enddate, '%m/%d/%Y')
+
+    Location = session.get('location', 'all')
+
+    try:
+        Rows = getUsageReport( startdate.strftime('%Y-%m-%d'), enddate.strftime('%Y-%m-%d'), period, group, Location )
+        Locations = cachedLocations()
+    except Exception as e:
+        return render_template( 'reports.html', error = repr(e) )
+
+    total_jobs = sum( row[2] for row in Rows )
+    total_pages = sum( row[3] for row in Rows )
+
+    return render_template( 'reports.html', rows = Rows, period = period, group = group, daterange = daterange,
+                            total_jobs = total_jobs, total_pages = total_pages, locations = Locations )
 
 @app.route( '/jobs/<int:id>' )
 @is_logged_in
@@ -218,7 +610,7 @@ def job( id ):
 
     try:
         Job = getPrintJob( id )
-        Locations = getLocations()
+        Locations = cachedLocations()
     except Exception as e:
         return render_template( 'job.html', error = repr(e) )
     else:
@@ -235,6 +627,8 @@ def release_job( id ):
     else:
         flash( 'Job ' + str(id) + ' Released', 'success' )
 
+    invalidateJobCache()
+
     # Get sort order to pass to the destination page
     sort = request.form.get('sort', None)
     sort_order = request.form.get('sort_order', None)
@@ -258,6 +652,63 @@ def cancel_job( id ):
     else:
         flash( 'Job ' + str(id) + ' Cancelled', 'success' )
 
+    invalidateJobCache()
+
+    # Get sort order to pass to the destination page
+    sort = request.form.get('sort', None)
+    sort_order = request.form.get('sort_order', None)
+
+    # Build sort order string
+    if sort == None:
+        sort_str = ''
+    else:
+        sort_str = '?sort=' + sort + '&order=' + sort_order
+
+    return redirect( url_for( 'jobs' )  + sort_str )
+
+@app.route( '/bulk_jobs', methods=['POST'] )
+@is_logged_in
+def bulk_jobs():
+
+    # Act on the ticked jobs, or on every job for a user and/or location
+    action = request.form.get('action', 'release')
+    job_ids = [ int( i ) for i in request.form.getlist('job_id') if i.isdigit() ]
+    user = request.form.get('user')
+    location = request.form.get('location')
+
+    if user and not location:
+        # Stay within the terminal's location
+        location = session.get('location', 'all')
+
+    wants_json = request.accept_mimetypes.best == 'application/json'
+
+    try:
+        results = bulkJobAction( action, job_ids, user, location )
+    except Exception as e:
+        if wants_json:
+            return jsonify( error = repr(e) ), 400
+
+        flash( repr(e), 'danger' )
+        results = []
+
+    invalidateJobCache()
+
+    if wants_json:
+        return jsonify( results = [ { 'job-id': job_id, 'ok': error == None, 'error': error } for job_id, error in results ] )
+
+    done = [ str(job_id) for job_id, error in results if error == None ]
+    failed = [ 'Job ' + str(job_id) + ': ' + error for job_id, error in results if error != None ]
+
+    if done:
+        verb = 'Released' if action == 'release' else 'Cancelled'
+        flash( verb + ' ' + str( len( done ) ) + ' job(s): ' + ', '.join( done ), 'success' )
+
+    if failed:
+        flash( 'Failed ' + str( len( failed ) ) + ' job(s). ' + '; '.join( failed ), 'danger' )
+
+    if not results and not failed:
+        flash( 'No jobs selected', 'warning' )
+
     # Get sort order to pass to the destination page
     sort = request.form.get('sort', None)
     sort_order = request.form.get('sort_order', None)
@@ -309,8 +760,8 @@ def set_location():
 def printers():
 
     try:
-        Printers = getPrinterList()
-        Locations = getLocations()
+        Printers = cachedPrinterList()
+        Locations = cachedLocations()
     except Exception as e:
         return render_template( 'printers.html', error = repr(e) )
 
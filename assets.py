@@ -0,0 +1,102 @@
+import hashlib
+import logging
+import os
+import re
+import threading
+
+LOG = logging.getLogger( 'wpr.assets' )
+
+# Third party assets and where they come from.  vendor.py downloads them into static/
+# so pages load without internet access.  The files aren't kept in git, so until it
+# has been run, or with VENDOR_ASSETS = 'cdn', pages link to the CDN copy instead.
+cdnBase = 'https://cdn.jsdelivr.net/npm/'
+
+vendorAssets = { 'vendor/bootstrap/bootstrap.min.css': 'bootstrap@5.3.8/dist/css/bootstrap.min.css',
+                 'vendor/bootstrap/bootstrap.bundle.min.js': 'bootstrap@5.3.8/dist/js/bootstrap.bundle.min.js',
+                 'vendor/font-awesome/css/font-awesome.min.css': 'font-awesome@4.7.0/css/font-awesome.min.css',
+                 'vendor/jquery/jquery.min.js': 'jquery@3.7.1/dist/jquery.min.js',
+                 'vendor/moment/moment.min.js': 'moment@2.30.1/min/moment.min.js',
+                 'vendor/daterangepicker/daterangepicker.css': 'daterangepicker@3.1.0/daterangepicker.css',
+                 'vendor/daterangepicker/daterangepicker.min.js': 'daterangepicker@3.1.0/daterangepicker.min.js'
+               }
+
+# Loaded by the stylesheets above through relative URLs rather than by our templates
+vendorFiles = { 'vendor/font-awesome/fonts/' + name: 'font-awesome@4.7.0/fonts/' + name
+                for name in [ 'fontawesome-webfont.eot', 'fontawesome-webfont.svg', 'fontawesome-webfont.ttf',
+                              'fontawesome-webfont.woff', 'fontawesome-webfont.woff2', 'FontAwesome.otf' ] }
+
+# Vendored files already reported missing
+missingVendor = set()
+
+def cdnUrl( filename, expected=True ):
+    """CDN URL for a vendored file.  Unless the CDN was asked for, say once per file
+       that the local copy is missing so the fallback doesn't go unnoticed.
+    """
+    if expected and filename not in missingVendor:
+        missingVendor.add( filename )
+        LOG.warning( 'static/%s is missing so it is served from the CDN.  Run vendor.py to serve it locally.', filename )
+
+    return cdnBase + vendorAssets[filename]
+
+hashedName = re.compile( r'^(.+)\.([0-9a-f]{12})(\.[^./]+)$' )
+
+class AssetTable:
+    """Content hashed names for static files.
+
+       app.css becomes app.<first 12 hex digits of its sha256>.css so the name
+       changes whenever the file does and browsers can cache it for good.
+       Hashes are remembered until the file's mtime or size changes.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.digests = {}
+
+    def digest(self, filename):
+        """Hash of a static file or None if it doesn't exist"""
+        path = os.path.join( self.folder, filename )
+
+        try:
+            st = os.stat( path )
+        except OSError:
+            return None
+
+        stamp = ( st.st_mtime_ns, st.st_size )
+
+        with self.lock:
+            known = self.digests.get( filename )
+
+        if known and known[0] == stamp:
+            return known[1]
+
+        with open( path, 'rb' ) as f:
+            digest = hashlib.sha256( f.read() ).hexdigest()[:12]
+
+        with self.lock:
+            self.digests[filename] = ( stamp, digest )
+
+        return digest
+
+    def name(self, filename):
+        """Hashed name for a static file, or None if it doesn't exist"""
+        digest = self.digest( filename )
+
+        if digest == None:
+            return None
+
+        base, ext = os.path.splitext( filename )
+
+        return base + '.' + digest + ext
+
+    def resolve(self, hashed):
+        """Map a hashed name back to (static file name, True if the hash is current).
+           Names without a hash come back unchanged with False.
+        """
+        match = hashedName.match( hashed )
+
+        if match == None:
+            return hashed, False
+
+        filename = match.group( 1 ) + match.group( 3 )
+
+        return filename, self.digest( filename ) == match.group( 2 )
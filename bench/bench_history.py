@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Date window queries on the history archive.
+
+   Archives 100k completed jobs over about 70 days and times one page of 100
+   rows for several filters, first with the current indexes and then with the
+   version 4 ones (no state in the date indexes).  For reference it also times
+   filtering the same jobs in Python, the old way with datetime.fromtimestamp
+   and with a sorted list and bisect.
+
+   python3 bench/bench_history.py [jobs]
+"""
+import bisect
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+import benchutil
+from benchutil import freshDb, medianMs, report
+import db
+
+def main():
+    count = int( sys.argv[1] ) if len( sys.argv ) > 1 else 100000
+
+    random.seed( 1 )
+
+    freshDb()
+    db.initDB()
+
+    now = int( time.time() )
+    locations = [ 'Main', 'Kids', 'Annex', 'Lab' ]
+
+    jobs = []
+    for i in range( count ):
+        completed = now - i * 60
+
+        jobs.append( { 'job-id': 1000000 + i,
+                       'job-name': 'doc ' + str( i ),
+                       'job-originating-user-name': 'user' + str( random.randrange( 500 ) ),
+                       'job-printer-uri': 'ipp://localhost/printers/p' + str( random.randrange( 8 ) ),
+                       'job-printer-location': random.choice( locations ),
+                       'job-state': random.choice( [ 9, 9, 9, 9, 7, 8 ] ),
+                       'job-k-octets': random.randrange( 1000 ),
+                       'page-count': 3,
+                       'printed-pages': 3,
+                       'copies': 1,
+                       'job-media-sheets-completed': 3,
+                       'time-at-creation': completed,
+                       'time-at-completed': completed } )
+
+    for i in range( 0, count, 5000 ):
+        db.putDbHistory( jobs[i:i + 5000] )
+
+    cases = [ ( '30 days, all locations', now - 30 * 86400, 'all', None, 'time-at-completed' ),
+              ( '30 days, one location', now - 30 * 86400, 'Main', None, 'time-at-completed' ),
+              ( '30 days, location + state', now - 30 * 86400, 'Main', [ 9 ], 'time-at-completed' ),
+              ( '1 day, location + state', now - 86400, 'Main', [ 9 ], 'time-at-completed' ),
+              ( '30 days, location + state, by user', now - 30 * 86400, 'Main', [ 9 ], 'job-originating-user-name' ) ]
+
+    def timeCases():
+        return [ medianMs( lambda: db.getDbHistory( start, now, location, states, sort, 'desc', 0, 100 ) )
+                 for name, start, location, states, sort in cases ]
+
+    after = timeCases()
+
+    # The version 4 indexes
+    conn = db.getConnection()
+    with conn:
+        conn.execute( "DROP INDEX history_time_completed" )
+        conn.execute( "DROP INDEX history_location" )
+        conn.execute( "CREATE INDEX history_time_completed ON history (time_completed)" )
+        conn.execute( "CREATE INDEX history_location ON history (location, time_completed)" )
+
+    before = timeCases()
+
+    report( 'History page of 100 from ' + str( count ) + ' archived jobs, median ms' )
+    report( '%-38s %10s %10s' % ( 'query', 'v4 index', 'v5 index' ) )
+
+    for ( name, start, location, states, sort ), b, a in zip( cases, before, after ):
+        report( '%-38s %10.2f %10.2f' % ( name, b, a ) )
+
+    # Filtering in Python, 30 days at one location, completed only
+    startdate = datetime.now() - timedelta( days=30 )
+    enddate = datetime.now() + timedelta( days=1 )
+
+    def fromtimestampFilter():
+        window = [ j for j in jobs if startdate <= datetime.fromtimestamp( j['time-at-completed'] ) <= enddate ]
+        window = [ j for j in window if j['job-state'] == 9 ]
+
+        return [ j for j in window if j['job-printer-location'] == 'Main' ]
+
+    ordered = sorted( jobs, key=lambda j: j['time-at-completed'] )
+    keys = [ j['time-at-completed'] for j in ordered ]
+
+    def bisectFilter():
+        low = bisect.bisect_left( keys, startdate.timestamp() )
+        high = bisect.bisect_right( keys, enddate.timestamp() )
+
+        return [ j for j in ordered[low:high] if j['job-state'] == 9 and j['job-printer-location'] == 'Main' ]
+
+    report( '%-38s %10.2f' % ( 'python, fromtimestamp filter', medianMs( fromtimestampFilter, 5 ) ) )
+    report( '%-38s %10.2f' % ( 'python, sorted list + bisect', medianMs( bisectFilter, 5 ) ) )
+    report()
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        benchutil.cleanup()
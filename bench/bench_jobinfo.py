@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Cost per job of looking up page counts and locations for a job list.
+
+   Compares the old pattern of two queries per job, each on its own connection,
+   with the single-id helpers on the shared connection and with one
+   getDbJobInfo call for the whole list.  Also times the bulk upsert.
+
+   python3 bench/bench_jobinfo.py [history rows]
+"""
+import sqlite3
+import sys
+import benchutil
+from benchutil import freshDb, medianMs, report
+import db
+
+def main():
+    history = int( sys.argv[1] ) if len( sys.argv ) > 1 else 20000
+
+    report( 'wpr.db job info lookups, ' + str( history ) + ' stored jobs, cost per job in us' )
+    report( '%6s %20s %20s %12s %12s' % ( 'jobs', 'per job, new conns', 'per job, shared', 'bulk', 'bulk write' ) )
+
+    for n in ( 50, 500, 5000 ):
+        path = freshDb()
+        db.initDB()
+
+        conn = db.getConnection()
+        with conn:
+            conn.executemany( "INSERT INTO jobs (id, pages, location, updated) VALUES (?, 2, 'Main', 0)",
+                              ( ( i, ) for i in range( history + n ) ) )
+
+        ids = list( range( history, history + n ) )
+
+        def perJobNewConnections():
+            # What db.py did before the bulk helpers: a connection and query per value
+            for i in ids:
+                for column in ( 'pages', 'location' ):
+                    c = sqlite3.connect( path )
+                    c.execute( 'SELECT ' + column + ' FROM jobs WHERE id=?', ( i, ) ).fetchone()
+                    c.close()
+
+        def perJobShared():
+            for i in ids:
+                db.getDbPageCount( i )
+                db.getDbJobLocation( i )
+
+        def bulk():
+            db.getDbJobInfo( ids )
+
+        def bulkWrite():
+            db.putDbJobInfo( [ ( i, 3, 'Main' ) for i in ids ] )
+
+        runs = 5 if n >= 5000 else 20
+
+        report( '%6d %20.1f %20.1f %12.2f %12.2f' % ( n,
+                                                      medianMs( perJobNewConnections, runs ) * 1000 / n,
+                                                      medianMs( perJobShared, runs ) * 1000 / n,
+                                                      medianMs( bulk, runs ) * 1000 / n,
+                                                      medianMs( bulkWrite, runs ) * 1000 / n ) )
+
+    report()
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        benchutil.cleanup()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Page count lookups before and after the v3 schema.
+
+   Builds a version 2 wpr.db (no key on jobs.id, some duplicate rows), times
+   lookups by id, migrates it with initDB and times the same lookups and a
+   1000 row upsert on the result.
+
+   python3 bench/bench_schema.py [rows]
+"""
+import random
+import sqlite3
+import sys
+import time
+import benchutil
+from benchutil import freshDb, medianMs, report
+import db
+
+def main():
+    rows = int( sys.argv[1] ) if len( sys.argv ) > 1 else 1000000
+
+    random.seed( 1 )
+
+    path = freshDb()
+
+    conn = sqlite3.connect( path )
+    conn.execute( "CREATE TABLE jobs (id integer, pages integer, location VARCHAR)" )
+    conn.execute( "CREATE TABLE ver (version integer)" )
+    conn.execute( "INSERT INTO ver VALUES (2)" )
+    conn.executemany( "INSERT INTO jobs VALUES (?, 3, 'Main')", ( ( i, ) for i in range( rows ) ) )
+
+    # Racing v2 workers left duplicates behind
+    conn.executemany( "INSERT INTO jobs VALUES (?, NULL, 'Kids')", ( ( i, ) for i in range( 0, rows, 1000 ) ) )
+    conn.commit()
+
+    ids = [ random.randrange( rows ) for i in range( 50 ) ]
+
+    def v2Lookups():
+        for i in ids:
+            conn.execute( "SELECT pages FROM jobs WHERE id=?", ( i, ) ).fetchone()
+
+    v2 = medianMs( v2Lookups, 3 ) * 1000 / len( ids )
+    conn.close()
+
+    start = time.perf_counter()
+    db.initDB()
+    migration = time.perf_counter() - start
+
+    ids = [ random.randrange( rows ) for i in range( 10000 ) ]
+
+    def v3Lookups():
+        for i in ids:
+            db.getDbPageCount( i )
+
+    v3 = medianMs( v3Lookups, 5 ) * 1000 / len( ids )
+
+    def upsert():
+        db.putDbJobInfo( [ ( i, 4, 'Main' ) for i in range( rows - 500, rows + 500 ) ] )
+
+    report( 'wpr.db schema, ' + str( rows ) + ' stored jobs' )
+    report( '  v2 lookup by id (table scan)   %10.1f us' % v2 )
+    report( '  v3 lookup by id (primary key)  %10.1f us' % v3 )
+    report( '  v2 -> v5 migration             %10.2f s' % migration )
+    report( '  1000 row upsert                %10.1f ms' % medianMs( upsert, 5 ) )
+    report()
+
+if __name__ == '__main__':
+    try:
+        main()
+    finally:
+        benchutil.cleanup()
@@ -0,0 +1,50 @@
+"""Shared set up for the benchmark scripts in this folder.
+
+   Benchmarks run against a scratch wpr.db in a temporary folder, never the one
+   named in config.py.  Results are printed and appended to bench_output.txt in
+   the top folder.
+"""
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, root )
+
+import config
+
+scratch = tempfile.mkdtemp( prefix='wpr-bench-' )
+
+def freshDb():
+    """Point db.py at a new empty wpr.db and return its path"""
+    import db
+
+    path = os.path.join( scratch, 'wpr-' + str( time.time_ns() ) + '.db' )
+
+    config.DB_PATH = path
+    db.local.conn = None
+
+    return path
+
+def medianMs( func, runs=20 ):
+    """Median wall time of func() in milliseconds"""
+    times = []
+
+    for i in range( runs ):
+        start = time.perf_counter()
+        func()
+        times.append( time.perf_counter() - start )
+
+    return statistics.median( times ) * 1000
+
+def report( line='' ):
+    print( line, flush=True )
+
+    with open( os.path.join( root, 'bench_output.txt' ), 'a' ) as f:
+        f.write( line + '\n' )
+
+def cleanup():
+    shutil.rmtree( scratch, ignore_errors=True )
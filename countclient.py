@@ -0,0 +1,35 @@
+import json
+import socket
+import config
+
+def countRequest( request, timeout=None ):
+    """Send one request to the page count service (countd.py) and return its reply.
+
+       Requests and replies are single lines of JSON on the COUNTD_SOCKET unix socket.
+    """
+    if timeout == None:
+        timeout = getattr( config, 'COUNTD_TIMEOUT', 2 )
+
+    sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    sock.settimeout( timeout )
+
+    try:
+        sock.connect( config.COUNTD_SOCKET )
+        sock.sendall( json.dumps( request ).encode() + b'\n' )
+
+        with sock.makefile( 'rb' ) as f:
+            line = f.readline()
+    except OSError as e:
+        raise Exception( 'Error: ' + repr(e) )
+    finally:
+        sock.close()
+
+    if not line:
+        raise Exception( 'Error: page count service closed the connection' )
+
+    reply = json.loads( line )
+
+    if 'error' in reply:
+        raise Exception( 'Error: ' + reply['error'] )
+
+    return reply
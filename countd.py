@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Page count service.
+
+   Holds the only write handle on wpr.db and runs the document parsers in its
+   own pool so web workers never do either.  It creates, migrates and prunes
+   the database, and web workers open it read only.  Listens on the
+   COUNTD_SOCKET unix socket for one line of JSON per request:
+
+     {"op": "count", "job_id": N, "printer_uri": U}            queue a count
+     {"op": "count", "job_id": N, "printer_uri": U, "wait": S}  count and wait up to S seconds
+     {"op": "lookup", "ids": [N, ...]}                           stored pages and locations
+     {"op": "put", "rows": [[N, pages, location], ...]}          store pages and locations
+     {"op": "history", "jobs": [job, ...], "mark": N,            archive completed jobs, then
+      "held": [N, ...]}                                          set the history watermark and
+                                                                 the active jobs below it
+"""
+import json
+import os
+import socketserver
+import config
+import counting
+import db
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from db import initDB, getDbJobInfo, putDbJobInfo, putDbHistory, putDbHistoryMark, flushDbWrites
+from maintenance import startMaintenance
+
+def handleRequest( request ):
+    op = request.get( 'op' )
+
+    if op == 'count':
+        future = counting.queuePageCount( request['printer_uri'], int( request['job_id'] ) )
+
+        if not request.get( 'wait' ):
+            return { 'queued': True }
+
+        pages = future.result( timeout=request['wait'] )
+
+        if pages == None:
+            # Claimed by another counter
+            pages = counting.waitPageCount( int( request['job_id'] ), getattr( config, 'COUNT_CLAIM_WAIT', 5 ) )
+
+        return { 'pages': pages }
+
+    if op == 'lookup':
+        info = getDbJobInfo( [ int( v ) for v in request['ids'] ] )
+
+        return { 'info': { str( k ): list( v ) for k, v in info.items() } }
+
+    if op == 'put':
+        putDbJobInfo( [ tuple( v ) for v in request['rows'] ] )
+
+        return { 'ok': True }
+
+    if op == 'history':
+        putDbHistory( request['jobs'] )
+
+        if request.get( 'mark' ) != None:
+            putDbHistoryMark( int( request['mark'] ), [ int( v ) for v in request.get( 'held', [] ) ] )
+
+        return { 'ok': True }
+
+    return { 'error': 'unknown op ' + repr(op) }
+
+class CountHandler( socketserver.StreamRequestHandler ):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = handleRequest( json.loads( line ) )
+            except TimeoutError:
+                reply = { 'error': 'count timed out' }
+            except Exception as e:
+                reply = { 'error': repr(e) }
+
+            self.wfile.write( json.dumps( reply ).encode() + b'\n' )
+
+class CountServer( socketserver.UnixStreamServer ):
+    """Answers connections on a fixed set of threads.  Each thread keeps its wpr.db
+       connection for the life of the service instead of opening one per request.
+    """
+    def __init__(self, path, handler, threads):
+        super().__init__( path, handler )
+        self.pool = ThreadPoolExecutor( max_workers=threads, thread_name_prefix='countd' )
+
+    def process_request(self, request, client_address):
+        self.pool.submit( self.serveRequest, request, client_address )
+
+    def serveRequest(self, request, client_address):
+        try:
+            self.finish_request( request, client_address )
+        except Exception:
+            self.handle_error( request, client_address )
+        finally:
+            self.shutdown_request( request )
+
+def main():
+    db.ownsDb = True
+
+    initDB()
+    startMaintenance()
+
+    path = config.COUNTD_SOCKET
+    os.makedirs( os.path.dirname( path ), exist_ok=True )
+
+    # Clear a socket left behind by an earlier run
+    try:
+        os.remove( path )
+    except FileNotFoundError:
+        pass
+
+    server = CountServer( path, CountHandler, getattr( config, 'COUNTD_THREADS', 8 ) )
+    os.chmod( path, 0o660 )
+
+    try:
+        server.serve_forever()
+    finally:
+        flushDbWrites()
+        os.remove( path )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+import config
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pypdf import PdfReader
+from cupspool import cupsCall
+from db import getDbPageCount, putDbPageCount, getDbCountFailure, pagesUnknown, getDbFingerprint, putDbFingerprint, bumpDbStat, claimDbJob, releaseDbJob
+import sys
+sys.path.insert(0,"./PageCounter")
+from PageCounter import detectPageCount
+
+def detectPageCountInternal( file ):
+    """Count the pages in a file"""
+
+    # Assuming PDF for now
+
+    try:
+        # Map the file read-only so large documents are paged in rather than copied
+        with open( file, 'rb' ) as pdfFileObj, mmap.mmap( pdfFileObj.fileno(), 0, access=mmap.ACCESS_READ ) as pdfMap:
+            # creating a pdf reader object
+            Reader = PdfReader( pdfMap )
+
+            # Get page count
+            result = len( Reader.pages )
+    except:
+        result ='0'
+
+    return result
+
+def fingerprintFile( file ):
+    """Fast content fingerprint of a document.
+
+       By default the size plus the first and last FINGERPRINT_BLOCK bytes are hashed,
+       which is enough to tell PDFs apart since the trailer holds the document ID.
+       Set FINGERPRINT_FULL to hash the whole file instead.
+    """
+
+    block = getattr( config, 'FINGERPRINT_BLOCK', 65536 )
+    digest = hashlib.sha256()
+
+    with open( file, 'rb' ) as f:
+        size = os.fstat( f.fileno() ).st_size
+        digest.update( str( size ).encode() )
+
+        if getattr( config, 'FINGERPRINT_FULL', False ) or size <= 2 * block:
+            for chunk in iter( lambda: f.read( 1024 * 1024 ), b'' ):
+                digest.update( chunk )
+        else:
+            digest.update( f.read( block ) )
+            f.seek( -block, os.SEEK_END )
+            digest.update( f.read( block ) )
+
+    return digest.hexdigest()
+
+def storedPageCount( job_id ):
+    """Stored page count for a job.  0 if it hasn't been counted or counting failed."""
+
+    return max( int( getDbPageCount( job_id ) or 0 ), 0 )
+
+def countFailed( job_id ):
+    """True if counting a job failed less than COUNT_RETRY_SECONDS ago"""
+
+    failed = getDbCountFailure( job_id )
+
+    return failed != None and time.time() - failed < getattr( config, 'COUNT_RETRY_SECONDS', 600 )
+
+def getPageCount( file, job_id ):
+    """Get either stored or newly detected page count"""
+
+    # Check DB
+    dbCount = storedPageCount( job_id )
+
+    if dbCount:
+        # Found in the DB
+        result = dbCount
+    elif file:
+        # Reprints of a document we have already counted don't need parsing
+        fingerprint = fingerprintFile( file )
+        result = getDbFingerprint( fingerprint )
+
+        if result:
+            bumpDbStat( 'fingerprint-hits' )
+        else:
+            bumpDbStat( 'fingerprint-misses' )
+
+            # See if we can detect page count internally
+            result = detectPageCountInternal( file )
+
+            if result == '0':
+                # Try with PageCounter
+                result = detectPageCount( file )
+
+            if result and result != '0':
+                putDbFingerprint( fingerprint, result )
+
+        if result != '0':
+            putDbPageCount( job_id, result )
+    else:
+        # Can't find page count anywhere
+        result = '0'
+
+    return int( result )
+
+# Background page counting.  Held jobs without a stored page count are handed
+# to this pool so /jobs never waits on getDocument() or the parsers.
+countPool = None
+countPending = {}
+countLock = threading.Lock()
+
+def getCountPool():
+    """Create the page counting pool on first use"""
+    global countPool
+
+    with countLock:
+        if countPool == None:
+            workers = getattr( config, 'COUNT_WORKERS', 2 )
+
+            if getattr( config, 'COUNT_USE_PROCESSES', False ):
+                countPool = ProcessPoolExecutor( max_workers=workers )
+            else:
+                countPool = ThreadPoolExecutor( max_workers=workers, thread_name_prefix='pagecount' )
+
+    return countPool
+
+def getSpoolFile( job_id, spool_dir=None ):
+    """Path of a job's first document in the CUPS spool, or None if spool-direct
+       counting is off or the file can't be read.
+    """
+
+    if spool_dir == None:
+        if not getattr( config, 'SPOOL_DIRECT', False ):
+            return None
+
+        spool_dir = getattr( config, 'SPOOL_DIR', '/var/spool/cups' )
+
+    path = os.path.join( spool_dir, 'd%05d-001' % job_id )
+
+    if os.access( path, os.R_OK ):
+        return path
+
+    return None
+
+def waitPageCount( job_id, wait ):
+    """Wait up to wait seconds for another worker to store a job's page count.
+       Returns None if it doesn't show up in time.
+    """
+
+    deadline = time.monotonic() + wait
+
+    while True:
+        dbCount = int( getDbPageCount( job_id ) or 0 )
+
+        if dbCount > 0:
+            return dbCount
+
+        if dbCount == pagesUnknown:
+            # The other worker couldn't count it either
+            return 0
+
+        if time.monotonic() >= deadline:
+            return None
+
+        time.sleep( 0.1 )
+
+def countJobDocument( job_printer_uri, job_id, wait=0 ):
+    """Find a job's document and store its page count.  Runs in the count pool.
+
+       Only one worker counts a job at a time.  If another has claimed it wait up to
+       wait seconds for its result, returning None if there isn't one yet.  Returns 0
+       when the job can't be counted.  A failed job isn't tried again for
+       COUNT_RETRY_SECONDS.
+    """
+
+    # Nothing to do if it has been counted already
+    dbCount = storedPageCount( job_id )
+
+    if dbCount:
+        return dbCount
+
+    if countFailed( job_id ):
+        return 0
+
+    if not claimDbJob( job_id, getattr( config, 'COUNT_CLAIM_LEASE', 300 ) ):
+        return waitPageCount( job_id, wait )
+
+    try:
+        try:
+            result = countClaimedJob( job_printer_uri, job_id )
+        except Exception:
+            putDbPageCount( job_id, pagesUnknown )
+            raise
+
+        if not result:
+            # Unsupported format or no document.  Show it as unknown until the retry.
+            putDbPageCount( job_id, pagesUnknown )
+
+        return result
+    finally:
+        releaseDbJob( job_id )
+
+def countClaimedJob( job_printer_uri, job_id ):
+    """Count a job we hold the claim on"""
+
+    # It may have been finished by another worker before we claimed it
+    dbCount = storedPageCount( job_id )
+
+    if dbCount:
+        return dbCount
+
+    # Count straight from the spool file when we can read it
+    spoolFile = getSpoolFile( job_id )
+
+    if spoolFile:
+        return getPageCount( spoolFile, job_id )
+
+    # Otherwise get a copy of the actual document being printed
+    document = cupsCall( 'getDocument', job_printer_uri, job_id, 1, timeout=getattr( config, 'CUPS_DOCUMENT_TIMEOUT', 120 ) )
+
+    try:
+        # Get a documents page count.  This also writes it to the DB.
+        result = getPageCount( document['file'], job_id )
+    finally:
+        # Cleanup the temp document file
+        os.remove( document['file'] )
+
+    return result
+
+def countJobDone( job_id, future ):
+    """Forget a finished count so a failed one can be queued again"""
+
+    with countLock:
+        countPending.pop( job_id, None )
+
+def queuePageCount( job_printer_uri, job_id ):
+    """Queue a job for background page counting unless it is already queued.
+       Returns the future for the count.
+    """
+
+    pool = getCountPool()
+
+    with countLock:
+        if job_id in countPending:
+            return countPending[job_id]
+
+        future = pool.submit( countJobDocument, job_printer_uri, job_id )
+        countPending[job_id] = future
+
+    future.add_done_callback( lambda f: countJobDone( job_id, f ) )
+
+    return future
+
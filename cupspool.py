@@ -0,0 +1,130 @@
+import cups
+import os
+import threading
+import config
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+class CupsTimeout(RuntimeError):
+    """A CUPS call took longer than its timeout"""
+    pass
+
+class CupsPool:
+    """Keeps a small set of open CUPS connections for this process.
+
+       Threads borrow a connection for the length of one call and hand it back
+       afterwards.  At most 'limit' connections exist at any time.  A connection
+       that fails with a RuntimeError or a server side IPPError is thrown away
+       and the call is retried once on a fresh connection.
+
+       A call that times out keeps running on its executor thread, so its slot is
+       only handed back once it really finishes.  While every slot is held by a
+       hung call new calls time out waiting for one.
+    """
+    def __init__(self, limit=4, timeout=30, factory=None):
+        self.limit = limit
+        self.timeout = timeout
+        self.factory = factory or cups.Connection
+        self.reset()
+
+    def reset(self):
+        """Drop all state.  Used at start up and after a fork."""
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore( self.limit )
+        self.executor = None
+
+    def checkFork(self):
+        """Connections can't be shared with a parent process so start over after a fork"""
+        if self.pid != os.getpid():
+            self.reset()
+
+    def acquire(self, timeout=None):
+        """Borrow an idle connection or open a new one"""
+        self.checkFork()
+
+        if not self.slots.acquire( timeout=timeout ):
+            raise CupsTimeout( 'No CUPS connection free after ' + str(timeout) + ' seconds' )
+
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+
+        try:
+            return self.factory()
+        except:
+            self.slots.release()
+            raise
+
+    def release(self, conn, healthy=True):
+        """Return a connection.  Unhealthy connections are closed by dropping them."""
+        if healthy:
+            with self.lock:
+                self.idle.append( conn )
+
+        self.slots.release()
+
+    def isConnectionError(self, e):
+        """True when an error means the connection itself is bad"""
+        if isinstance( e, CupsTimeout ):
+            # A hung server won't answer a retry either
+            return False
+
+        if isinstance( e, cups.IPPError ):
+            # Server error class.  Client errors like not-found are the caller's problem.
+            return e.args[0] >= 0x0500
+
+        return isinstance( e, RuntimeError )
+
+    def invoke(self, conn, method, args, kwargs, timeout):
+        """Run one call on a connection, giving up after timeout seconds"""
+        if not timeout:
+            return getattr( conn, method )( *args, **kwargs )
+
+        with self.lock:
+            if self.executor == None:
+                self.executor = ThreadPoolExecutor( max_workers=self.limit, thread_name_prefix='cups' )
+
+        future = self.executor.submit( getattr( conn, method ), *args, **kwargs )
+
+        try:
+            return future.result( timeout=timeout )
+        except TimeoutError:
+            # The executor thread is still busy.  Free the slot when it is done.
+            future.add_done_callback( lambda f: self.slots.release() )
+
+            raise CupsTimeout( 'CUPS ' + method + ' timed out after ' + str(timeout) + ' seconds' )
+
+    def call(self, method, *args, timeout=None, **kwargs):
+        """Call a cups.Connection method on a pooled connection"""
+        if timeout == None:
+            timeout = self.timeout
+
+        for attempt in range( 2 ):
+            conn = self.acquire( timeout or None )
+
+            try:
+                result = self.invoke( conn, method, args, kwargs, timeout )
+            except CupsTimeout:
+                # The connection is dropped and invoke frees the slot later
+                raise
+            except (RuntimeError, cups.IPPError) as e:
+                self.release( conn, healthy=False )
+
+                if attempt or not self.isConnectionError( e ):
+                    raise
+            except:
+                self.release( conn, healthy=False )
+                raise
+            else:
+                self.release( conn )
+
+                return result
+
+pool = CupsPool( limit=getattr( config, 'CUPS_MAX_CONNECTIONS', 4 ),
+                 timeout=getattr( config, 'CUPS_TIMEOUT', 30 ) )
+
+def cupsCall( method, *args, **kwargs ):
+    """Call a cups.Connection method through the shared pool"""
+
+    return pool.call( method, *args, **kwargs )
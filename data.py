@@ -3,61 +3,101 @@ import json
 import subprocess
 import os
 import config
-from pypdf import PdfReader
-from db import getDbPageCount, putDbPageCount, getDbJobLocation, putDbJobLocation
-import sys
-sys.path.insert(0,"./PageCounter")
-from PageCounter import detectPageCount
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cupspool import cupsCall
+from countclient import countRequest
+from jobtable import jobTable, jobAttributes
+from snapshot import Snapshot
+from jobevents import JobEventHub
+from jobrecord import JobList
+from db import pagesUnknown, historyColumns, getDbJobInfo, putDbJobInfo, putDbHistory, putDbHistoryMark, getDbHistoryHeld, getDbHistory, getDbSyncMark, getDbStats, getDbUsage
+
+def countingModule():
+    """The parsers, imported only when this process counts pages itself.  With a
+       page count service configured web workers never load pypdf or PageCounter.
+    """
+    import counting
+
+    return counting
+
+def useCountService():
+    return getattr( config, 'COUNTD_SOCKET', None ) != None
+
+def queuePageCount( job_printer_uri, job_id ):
+    """Queue a job for background page counting unless it is already queued"""
+
+    if useCountService():
+        try:
+            countRequest( { 'op': 'count', 'job_id': job_id, 'printer_uri': job_printer_uri } )
+        except Exception:
+            # The job stays pending and is queued again on the next refresh
+            pass
 
-def detectPageCountInternal( file ):
-    """Count the pages in a file"""
+        return
 
-    # Assuming PDF for now
+    countingModule().queuePageCount( job_printer_uri, job_id )
 
-    try:
-        # creating a pdf file object
-        pdfFileObj = open( file , 'rb' )
+def countJobDocument( job_printer_uri, job_id ):
+    """Count a job's pages now and return the count.  Returns None if another
+       worker is counting it and doesn't finish within COUNT_CLAIM_WAIT seconds,
+       and 0 if it can't be counted.
+    """
 
-        # creating a pdf reader object
-        Reader = PdfReader( pdfFileObj )
+    wait = getattr( config, 'COUNT_CLAIM_WAIT', 5 )
 
-        # Get page count
-        result = len( Reader.pages )
-    except:
-        result ='0'
+    if useCountService():
+        timeout = getattr( config, 'CUPS_DOCUMENT_TIMEOUT', 120 ) + wait
+        reply = countRequest( { 'op': 'count', 'job_id': job_id, 'printer_uri': job_printer_uri, 'wait': timeout }, timeout=timeout + 5 )
 
-    return result
+        return reply['pages']
 
-def getPageCount( file, job_id ):
-    """Get either stored or newly detected page count"""
+    return countingModule().countJobDocument( job_printer_uri, job_id, wait=wait )
 
-    # Check DB
-    dbCount = getDbPageCount( job_id )
+def lookupJobInfo( job_ids ):
+    """Stored page counts and locations as {job_id: (pages, location)}"""
 
-    if dbCount:
-        # Found in the DB
-        result = dbCount
-    elif file:
-        # See if we can detect page count internally
-        result = detectPageCountInternal( file )
+    if useCountService():
+        reply = countRequest( { 'op': 'lookup', 'ids': list( job_ids ) } )
 
-        if result == '0':
-            # Try with PageCounter
-            result = detectPageCount( file )
+        return { int( k ): tuple( v ) for k, v in reply['info'].items() }
 
-        if result != '0':
-            putDbPageCount( job_id, result )
+    return getDbJobInfo( job_ids )
+
+def storeJobInfo( rows ):
+    """Store (job_id, pages, location) rows.  None leaves a stored value alone."""
+
+    if not rows:
+        return
+
+    if useCountService():
+        countRequest( { 'op': 'put', 'rows': rows } )
     else:
-        # Can't find page count anywhere
-        result = '0'
+        putDbJobInfo( rows )
 
-    return int( result )
+def storeHistory( joblist, mark, held ):
+    """Archive completed jobs, then move the 'history' watermark on to mark and
+       remember the held job ids below it
+    """
+
+    if useCountService():
+        # A batch at a time so no request is too big to answer within COUNTD_TIMEOUT
+        for i in range( 0, len( joblist ), 500 ):
+            countRequest( { 'op': 'history', 'jobs': [ { key: v.get( key ) for col, key in historyColumns } for v in joblist[i:i + 500] ] } )
+
+        countRequest( { 'op': 'history', 'jobs': [], 'mark': mark, 'held': held } )
+
+        return
+
+    putDbHistory( joblist )
+    putDbHistoryMark( mark, held )
 
 def getJobLocation( job_id, job_printer_uri ):
     """Get the printer location for a job"""
 
     # Check DB for location
-    dbLocation = getDbJobLocation( job_id )
+    dbLocation = lookupJobInfo( [ job_id ] ).get( job_id, ( None, None ) )[1]
 
     if dbLocation:
         # Found in the DB
@@ -66,11 +106,15 @@ def getJobLocation( job_id, job_printer_uri ):
         offset = job_printer_uri.rfind( '/' )
         printerName = job_printer_uri[offset + 1:]
 
-        PrinterAttrs = getPrinterAttrs( printerName )
-        Location = PrinterAttrs.get('printer-location', 'Unknown')
-        putDbJobLocation( job_id, Location )
+        Location = getPrinterLocation( printerName )
+
+        if Location == None:
+            # Printer has gone away.  Don't store a guess.
+            result = 'Unknown'
+        else:
+            storeJobInfo( [ ( job_id, None, Location ) ] )
 
-        result = Location
+            result = Location
 
     return result
 
@@ -88,41 +132,61 @@ def calcPrintedPages( page_count, copies, sheets_completed, job_state ):
 
     return int( result )
 
-def getPrintJobs( which_jobs_in='not-completed', sort='job-originating-user-name', sort_order='asc' ):
-    
-    # Show all active jobs but limit completed.  Set limit in config.py
-    if which_jobs_in=='not-completed':
-        result_limit = -1
-    else:
-        try:
-            result_limit = config.COMPLETED_LIMIT
-        except:
-            # use a safe default
-            result_limit = 100
+def enrichJobs( joblist, which_jobs_in='not-completed' ):
+    """Add page counts, printed pages and locations to a list of jobs in place"""
 
-    try:
-        conn = cups.Connection()
+    # Look up stored page counts and locations for the whole list at once
+    info = lookupJobInfo( [ v['job-id'] for v in joblist ] )
+    newLocations = []
 
-        # Just retrieve these attributes.  'All' was sometimes returning partial reselt sets.
-        r = ["job-id",
-             "job-name",
-             "job-state",
-             "job-printer-uri",
-             "job-originating-user-name",
-             "job-k-octets",
-             "time-at-creation",
-             "job-media-sheets-completed",
-             "time-at-completed",
-             "Duplex",
-             "copies"
-            ]
+    for v in joblist:
+        k = v['job-id']
+
+        pages, location = info.get( k, ( None, None ) )
+
+        # Page count from the DB
+        pages = int( pages or 0 )
+        v['page-count'] = max( pages, 0 )
+
+        if pages == pagesUnknown:
+            # Counting failed.  It is tried again after COUNT_RETRY_SECONDS.
+            v['page-count-failed'] = True
+
+        # Document not available for completed jobs.  Count held jobs in the background
+        # and show them as pending until the worker has stored the count.
+        if which_jobs_in=='not-completed' and not v['page-count']:
+            queuePageCount( v['job-printer-uri'], v['job-id'] )
+
+            if pages != pagesUnknown:
+                v['page-count-pending'] = True
+
+        v['printed-pages'] = calcPrintedPages( v.get('page-count', 0), v.get('copies', 1), v.get('job-media-sheets-completed', 0), v.get('job-state', 0) )
+
+        if not location:
+            job_printer_uri = v.get('job-printer-uri', 'Unknown')
+            location = getPrinterLocation( job_printer_uri[job_printer_uri.rfind( '/' ) + 1:] )
+
+            if location == None:
+                # Printer has gone away.  Don't store a guess.
+                location = 'Unknown'
+            else:
+                newLocations.append( ( k, None, location ) )
+
+        v['job-printer-location'] = location
+
+    # Store any new locations in one transaction
+    storeJobInfo( newLocations )
 
-        # Get all jobs
-        jobs = conn.getJobs( which_jobs=which_jobs_in,
-                             my_jobs=False,
-                             limit=result_limit,
-                             first_job_id=-1,
-                             requested_attributes=r )
+    return joblist
+
+def buildPrintJobs():
+    """Build the enriched, unsorted list of active jobs that the job snapshot holds"""
+
+    try:
+        # Active jobs come from the event driven job table.  The snapshot is rebuilt
+        # at most every SNAPSHOT_MAX_AGE seconds so always check for new events.
+        jobTable.expire()
+        jobs = jobTable.getJobs()
     except RuntimeError as e:
         raise Exception( 'Error: ' + repr(e) )
         return
@@ -131,52 +195,303 @@ def getPrintJobs( which_jobs_in='not-completed', sort='job-originating-user-name
         return
 
     # Merge job-id into the dictionary and create a new list of dicts
-    # with some added information.
     joblist = []
     for k, v in jobs.items():
         v['job-id'] = k
 
-        # Document not available for completed jobs
-        if which_jobs_in=='not-completed':
-            # Check DB
-            dbCount = getPageCount( None, v['job-id'] )
+        joblist.append(v)
 
-            if dbCount:
-                # Found in the DB
-                v['page-count'] = dbCount
-            else:
-                # Get a copy of the actual document being printed
-                document = conn.getDocument( v['job-printer-uri'], v['job-id'], 1 )
+    enrichJobs( joblist, 'not-completed' )
 
-                # Get a documents page count
-                v['page-count'] = getPageCount( document['file'], v['job-id'] )
+    return joblist
+
+def trackJobChanges( previous, joblist ):
+    """Wrap a job list with the bookkeeping needed to send clients only what changed.
+
+       The state version only moves when a job is added, changed or removed.  Each
+       job remembers the version it was added and last changed in, and removed jobs
+       are remembered for JOB_DIFF_WINDOW seconds.  Changes since any version from
+       'horizon' on can be worked out.  Older versions need the full list.
+    """
+
+    version = time.time_ns() // 1000
+
+    if not isinstance( previous, dict ) or 'horizon' not in previous:
+        previous = { 'version': version, 'horizon': version, 'jobs': [], 'added': {}, 'changed': {}, 'removed': {} }
+
+    # Compare as they come back from the snapshot file
+    joblist = json.loads( json.dumps( joblist ) )
 
-                # Cleanup the temp document file
-                os.remove( document['file'] )
+    old = { str( v['job-id'] ): v for v in previous['jobs'] }
+    new = { str( v['job-id'] ): v for v in joblist }
+
+    added = {}
+    changed = {}
+    removed = { k: t for k, t in previous['removed'].items() if k not in new }
+    dirty = False
+
+    for k, v in new.items():
+        if k not in old:
+            added[k] = changed[k] = version
+            dirty = True
+        elif old[k] != v:
+            added[k] = previous['added'][k]
+            changed[k] = version
+            dirty = True
         else:
-            # No file so try db for page count
-            v['page-count'] = getPageCount( None, v['job-id'] )
+            added[k] = previous['added'][k]
+            changed[k] = previous['changed'][k]
 
-        v['printed-pages'] = calcPrintedPages( v.get('page-count', 0), v.get('copies', 1), v.get('job-media-sheets-completed', 0), v.get('job-state', 0) )
+    for k in old:
+        if k not in new:
+            removed[k] = version
+            dirty = True
 
-        v['job-printer-location'] = getJobLocation( v['job-id'], v.get('job-printer-uri', 'Unknown'))
+    # Forget old removals.  Diffs from before the newest one forgotten aren't possible.
+    horizon = previous['horizon']
+    cutoff = version - getattr( config, 'JOB_DIFF_WINDOW', 600 ) * 1000000
 
-        joblist.append(v)
+    for k, t in list( removed.items() ):
+        if t < cutoff:
+            del removed[k]
+            horizon = max( horizon, t )
 
-    if sort_order == 'asc':
-        # Sort the list by username, job-id ascending.  -k['job-id'] would be decending.
-        joblist.sort(key = lambda k: k[sort] )
-    else:
-        # Sort Desc
-        joblist.sort(key = lambda k: k[sort], reverse=True )
+    if not dirty:
+        version = previous['version']
+
+    return { 'version': version, 'horizon': horizon, 'jobs': joblist, 'added': added, 'changed': changed, 'removed': removed }
+
+def buildJobState():
+    """Build the job snapshot contents from CUPS and the previous snapshot"""
+
+    previous = jobSnapshot.read()
+
+    return trackJobChanges( previous['data'] if previous else None, buildPrintJobs() )
+
+# Active job list shared by all workers.  One worker rebuilds it when it is older than
+# SNAPSHOT_MAX_AGE seconds and the rest read the file it writes.
+jobSnapshot = Snapshot( os.path.join( getattr( config, 'SNAPSHOT_DIR', '/tmp/webprint' ), 'jobs-not-completed.json' ),
+                        buildJobState,
+                        max_age=getattr( config, 'SNAPSHOT_MAX_AGE', 5 ),
+                        stale_limit=getattr( config, 'SNAPSHOT_STALE_LIMIT', 30 ) )
+
+def expirePrintJobs():
+    """Make the next job list read rebuild from CUPS"""
+
+    jobTable.expire()
+    jobSnapshot.expire()
+
+def getJobState():
+    """Current active jobs as {'version', 'horizon', 'jobs', 'added', 'changed', 'removed'}.
+       See trackJobChanges.
+    """
+
+    return jobSnapshot.get()['data']
+
+def getJobChanges( state, since, location='all' ):
+    """Jobs at a location added or changed after version since, and the ids of
+       jobs removed from it.  Returns None if since is too old to work out.
+    """
+
+    if since < state['horizon']:
+        return None
+
+    added = []
+    changed = []
+    removed = [ int( k ) for k, t in state['removed'].items() if t > since ]
+
+    for v in state['jobs']:
+        k = str( v['job-id'] )
+
+        if state['changed'][k] <= since:
+            continue
+
+        if location != 'all' and v['job-printer-location'] != location:
+            # Moved away from this location as far as the client knows
+            removed.append( v['job-id'] )
+        elif state['added'][k] > since:
+            added.append( v )
+        else:
+            changed.append( v )
+
+    return { 'added': added, 'changed': changed, 'removed': removed }
+
+# Pushes job changes to terminals listening on /api/jobs/events
+jobEventHub = JobEventHub( getJobState, getJobChanges, interval=getattr( config, 'JOB_EVENT_INTERVAL', 2 ) )
+
+def getHistoryVersion():
+    """Version of the history archive.  Moves whenever jobs are added or pruned.
+
+       Read straight from wpr.db so an unchanged archive costs no CUPS call.  A sync
+       that is due runs in the background and shows up in a later version.
+    """
+
+    syncHistoryInBackground()
+
+    return getDbSyncMark( 'history-version' ) or 0
+
+def getPrintJobs( which_jobs_in='not-completed', sort='job-originating-user-name', sort_order='asc' ):
+
+    if which_jobs_in!='not-completed':
+        # Completed jobs come from the history archive.  Limit them.  Set limit in config.py
+        try:
+            result_limit = config.COMPLETED_LIMIT
+        except:
+            # use a safe default
+            result_limit = 100
+
+        joblist, total = getCompletedJobs( 0, time.time() + 86400, sort=sort, sort_order=sort_order, limit=result_limit )
+
+        return joblist
+
+    # Active jobs come back as JobRecords in a shared, cached order
+    return getJobList().ordered( sort, sort_order )
+
+# Job records for the newest snapshot version this process has seen
+jobListCache = { 'list': None }
+jobListLock = threading.Lock()
+
+def getJobList( state=None ):
+    """JobList for the current snapshot, or for state, built once per version"""
+
+    if state == None:
+        state = getJobState()
+
+    with jobListLock:
+        joblist = jobListCache['list']
+
+        if joblist == None or joblist.version != state['version']:
+            joblist = JobList( state['version'], state['jobs'] )
+            jobListCache['list'] = joblist
 
     return joblist
 
-def getPrintJob( job_id ):
+# Completed jobs are archived in wpr.db.  Each sync imports completed jobs from the
+# 'history' watermark on, which is one past the newest job id seen, and checks the
+# jobs that were still active below it last time.  The cost follows the number of
+# new and held jobs rather than the size of the history.
+historySyncAt = 0
+historySyncLock = threading.Lock()
+
+def syncHistory( force=False ):
+    """Import jobs that completed since the last sync into the history archive.
+       Returns the number of jobs imported.
+    """
+    global historySyncAt
+
+    if not force and time.monotonic() < historySyncAt:
+        return 0
+
+    if not historySyncLock.acquire( blocking=False ):
+        # Another thread is already syncing
+        return 0
+
+    try:
+        # The next sync waits a full interval even if this one fails, so a hung cupsd
+        # holds up one history page per interval rather than all of them
+        historySyncAt = time.monotonic() + getattr( config, 'HISTORY_SYNC_INTERVAL', 30 )
+
+        mark = getDbSyncMark( 'history' ) or 1
+        held = getDbHistoryHeld()
+
+        try:
+            # Fetched before the completed list so a job finishing in between is in both
+            # rather than neither
+            jobTable.expire()
+            active = jobTable.getJobs()
+
+            completed = cupsCall( 'getJobs',
+                                  which_jobs='completed',
+                                  my_jobs=False,
+                                  limit=-1,
+                                  first_job_id=mark,
+                                  requested_attributes=jobAttributes )
+
+            # Held jobs that have left the active list since the last sync
+            waiting = []
+            for job_id in held:
+                if job_id in active or job_id in completed:
+                    continue
+
+                try:
+                    job = cupsCall( 'getJobAttributes', job_id=job_id, requested_attributes=jobAttributes )
+                except cups.IPPError:
+                    # Purged from CUPS
+                    continue
+
+                if job.get( 'job-state', 0 ) >= 7:
+                    completed[job_id] = job
+                else:
+                    waiting.append( job_id )
+        except RuntimeError as e:
+            raise Exception( 'Error: ' + repr(e) )
+            return
+        except cups.IPPError as e:
+            raise Exception( 'Error: ' + e.description )
+            return
+
+        joblist = []
+        for k, v in completed.items():
+            v['job-id'] = k
+
+            joblist.append(v)
+
+        enrichJobs( joblist, 'completed' )
+
+        # Next time start after the newest job seen and check the ones still active
+        storeHistory( joblist,
+                      max( list( completed.keys() ) + list( active.keys() ) + [ mark - 1 ] ) + 1,
+                      [ k for k in active if k not in completed ] + waiting )
+
+        return len( joblist )
+    finally:
+        historySyncLock.release()
+
+def syncHistoryQuietly():
+    try:
+        syncHistory()
+    except Exception:
+        # Tried again once HISTORY_SYNC_INTERVAL has passed
+        pass
+
+def syncHistoryInBackground():
+    """Start a history sync on its own thread if one is due"""
+
+    if time.monotonic() < historySyncAt or historySyncLock.locked():
+        return
+
+    threading.Thread( target=syncHistoryQuietly, name='historysync', daemon=True ).start()
+
+def getCompletedJobs( start, end, location='all', states=None, sort='time-at-completed', sort_order='desc', offset=0, limit=100, stream=False ):
+    """Get one page of job history from the local archive.
+
+       start and end are epoch seconds.  Returns (jobs, total matching jobs).  With
+       stream jobs is a generator.
+    """
 
     try:
-        conn = cups.Connection()
+        syncHistory()
+    except Exception:
+        # The archive is still worth showing when CUPS can't be reached
+        pass
+
+    return getDbHistory( start, end, location, states, sort, sort_order, offset, limit, stream )
+
+def getUsageReport( start_day, end_day, period='day', group='location', location='all' ):
+    """Pages and jobs printed per period from the usage rollup.
 
+       start_day and end_day are 'YYYY-MM-DD' and inclusive.  Returns a list of
+       (period, group value, jobs, pages).  Only reads wpr.db.  A history sync that
+       is due runs in the background and shows up in a later report.
+    """
+
+    syncHistoryInBackground()
+
+    return getDbUsage( start_day, end_day, period, group, location )
+
+def getPrintJob( job_id ):
+
+    try:
         # Just retrieve these attributes.  'All' was sometimes returning partial reselt sets.
         r = ["job-id",
              "job-name",
@@ -206,7 +521,7 @@ def getPrintJob( job_id ):
             ]
 
         # Get a job
-        job = conn.getJobAttributes( job_id=job_id, requested_attributes=r )
+        job = cupsCall( 'getJobAttributes', job_id=job_id, requested_attributes=r )
     except RuntimeError as e:
         raise Exception( 'Error: ' + repr(e) )
         return
@@ -215,17 +530,17 @@ def getPrintJob( job_id ):
         return
 
     try:
-        # Get a copy of the actual document being printed
-        document = conn.getDocument( job['job-printer-uri'], job['job-id'], 1 )
+        # Get the stored page count or count the document now
+        job['page-count'] = countJobDocument( job['job-printer-uri'], job['job-id'] )
     except:
-        # No file so check database for page count
-        job['page-count'] = getPageCount( None, job['job-id'] )
-    else:
-        # Get a documents page count
-        job['page-count'] = getPageCount( document['file'], job['job-id'] )
+        job['page-count'] = None
+
+    if not job['page-count']:
+        # No file, still being counted elsewhere or counting failed so check database for page count
+        pages = int( lookupJobInfo( [ job['job-id'] ] ).get( job['job-id'], ( None, None ) )[0] or 0 )
 
-        # Cleanup the temp document file
-        os.remove( document['file'] )
+        job['page-count'] = max( pages, 0 )
+        job['page-count-failed'] = pages == pagesUnknown
 
     job['printed-pages'] = calcPrintedPages( job.get('page-count', 0), job.get('copies', 1), job.get('job-media-sheets-completed', 0), job.get('job-state', 0) )
     
@@ -233,11 +548,31 @@ def getPrintJob( job_id ):
 
     return job
 
-def getPrinterList():
+# Printer metadata cache.  getPrinters() already returns the location and state
+# of every queue so one bulk call fills the name -> attributes map.  Full
+# attribute sets for the printers page are fetched per printer on demand and
+# expire along with the map.
+printerCache = { 'expires': 0, 'loaded': 0, 'printers': {}, 'attrs': {} }
+printerCacheLock = threading.Lock()
+
+def invalidatePrinterCache():
+    """Force the next lookup to reload printer metadata from CUPS.  Called when CUPS
+       names a printer the cache doesn't know or can't find one it does.
+    """
+
+    with printerCacheLock:
+        printerCache['expires'] = 0
+        printerCache['attrs'] = {}
+
+def getPrinterCache():
+    """Get the cached name -> attributes map, reloading it once the TTL has passed"""
+
+    with printerCacheLock:
+        if time.monotonic() < printerCache['expires']:
+            return printerCache['printers']
 
     try:
-        conn = cups.Connection()
-        printers = conn.getPrinters()
+        printers = cupsCall( 'getPrinters' )
     except RuntimeError as e:
         raise Exception( 'Error: ' + repr(e) )
         return
@@ -245,9 +580,51 @@ def getPrinterList():
         raise Exception( 'Error: ' + e.description )
         return
 
-    printerlist = []
     for k, v in printers.items():
-        printer = getPrinterAttrs( k )
+        v['printer-name'] = k
+
+    with printerCacheLock:
+        printerCache['printers'] = printers
+        printerCache['attrs'] = {}
+        printerCache['expires'] = time.monotonic() + getattr( config, 'PRINTER_CACHE_TTL', 60 )
+        printerCache['loaded'] = time.monotonic()
+
+    return printers
+
+def getPrinterLocation( name ):
+    """Get a printer's location from the cache.  None if the printer is unknown."""
+
+    printer = getPrinterCache().get( name )
+
+    if printer == None:
+        with printerCacheLock:
+            # Perhaps added since the cache was filled.  Reload, but not for every job
+            # on a queue that is really gone.
+            reload = time.monotonic() - printerCache['loaded'] > getattr( config, 'PRINTER_CACHE_RETRY', 10 )
+
+        if reload:
+            invalidatePrinterCache()
+            printer = getPrinterCache().get( name )
+
+    if printer == None:
+        return None
+
+    return printer.get( 'printer-location', 'Unknown' )
+
+def getPrinterList():
+
+    printers = getPrinterCache()
+
+    printerlist = []
+    for k in printers:
+        with printerCacheLock:
+            printer = printerCache['attrs'].get( k )
+
+        if printer == None:
+            printer = getPrinterAttrs( k )
+
+            with printerCacheLock:
+                printerCache['attrs'][k] = printer
 
         printerlist.append( printer )
 
@@ -255,21 +632,11 @@ def getPrinterList():
 
 def getLocations():
 
-    try:
-        conn = cups.Connection()
-        printers = conn.getPrinters()
-    except RuntimeError as e:
-        raise Exception( 'Error: ' + repr(e) )
-        return
-    except cups.IPPError as e:
-        raise Exception( 'Error: ' + e.description )
-        return
+    printers = getPrinterCache()
 
     locations = []
     for k, v in printers.items():
-        printer = getPrinterAttrs( k )
-
-        locations.append( printer.get('printer-location', 'Unknown') )
+        locations.append( v.get('printer-location', 'Unknown') )
 
     locations = list(set(locations)) 
     locations.sort()
@@ -279,23 +646,27 @@ def getLocations():
 def getPrinterAttrs( name ):
 
     try:
-        conn = cups.Connection()
-        printerAttrs = conn.getPrinterAttributes( name )
+        printerAttrs = cupsCall( 'getPrinterAttributes', name )
     except RuntimeError as e:
         raise Exception( 'Error: ' + repr(e) )
         return
     except cups.IPPError as e:
+        # The printer has probably been deleted or renamed
+        invalidatePrinterCache()
+
         raise Exception( 'Error: ' + e.description )
         return
 
     return printerAttrs
 
-def releaseJob( job_id ):
+def releaseJob( job_id, refresh=True ):
 
     try:
-        conn = cups.Connection()
         # Release the job
-        jobs = conn.setJobHoldUntil( job_id, 'no-hold' )
+        jobs = cupsCall( 'setJobHoldUntil', job_id, 'no-hold' )
+
+        if refresh:
+            expirePrintJobs()
     except RuntimeError as e:
         raise Exception( 'Error: ' + repr(e) )
         return
@@ -305,12 +676,14 @@ def releaseJob( job_id ):
 
     return
 
-def cancelJob( job_id ):
+def cancelJob( job_id, refresh=True ):
 
     try:
-        conn = cups.Connection()
         # Cancel the job.  False just cancels.  True cancels and purges the job from history.
-        jobs = conn.cancelJob( job_id, False )
+        jobs = cupsCall( 'cancelJob', job_id, False )
+
+        if refresh:
+            expirePrintJobs()
     except RuntimeError as e:
         raise Exception( 'Error: ' + repr(e) )
         return
@@ -319,3 +692,52 @@ def cancelJob( job_id ):
         return
 
     return
+
+def bulkJobAction( action, job_ids=None, user=None, location=None ):
+    """Release or cancel many jobs at once.
+
+       Acts on job_ids, or on every active job matching user and/or location when
+       no ids are given.  The IPP calls run concurrently, BULK_WORKERS at a time,
+       and the job list is rebuilt once at the end.  Returns a list of
+       (job_id, error) with error None for jobs that succeeded.
+    """
+
+    actions = { 'release': releaseJob, 'cancel': cancelJob }
+
+    if action not in actions:
+        raise Exception( 'Error: unknown action ' + repr(action) )
+
+    if location == 'all':
+        # Every location is no location filter at all
+        location = None
+
+    if not job_ids:
+        if not user and not location:
+            # Never act on every job by accident
+            return []
+
+        job_ids = [ j['job-id'] for j in getJobState()['jobs']
+                    if ( not user or j.get('job-originating-user-name') == user )
+                    and ( not location or j.get('job-printer-location') == location ) ]
+
+    def run( job_id ):
+        try:
+            actions[action]( job_id, refresh=False )
+        except Exception as e:
+            return ( job_id, str(e) )
+
+        return ( job_id, None )
+
+    with ThreadPoolExecutor( max_workers=getattr( config, 'BULK_WORKERS', 4 ), thread_name_prefix='bulk' ) as pool:
+        results = list( pool.map( run, job_ids ) )
+
+    expirePrintJobs()
+
+    return results
+
+def getCountStats():
+    """Page count cache counters shared by all workers"""
+
+    stats = getDbStats()
+
+    return { 'hits': stats.get( 'fingerprint-hits', 0 ), 'misses': stats.get( 'fingerprint-misses', 0 ) }
@@ -1,10 +1,73 @@
 import sqlite3
+import atexit
+import json
+import os
+import threading
+import time
+import urllib.request
+import config
+
+# One connection per process and thread, opened on first use
+local = threading.local()
+
+# Set by countd.py, and when db.py is run on its own.  With COUNTD_SOCKET set the page
+# count service holds the only write handle on wpr.db and web workers open it read only.
+ownsDb = False
+
+def isReadOnly():
+    """True when this process must leave writing wpr.db to the page count service"""
+    return getattr( config, 'COUNTD_SOCKET', None ) != None and not ownsDb
+
+def getConnection():
+    """Get this thread's connection to wpr.db, opening it if needed.
+
+       The database runs in WAL mode so readers don't block the writer, and
+       busy_timeout makes a worker wait for a lock instead of failing with
+       "database is locked".
+    """
+    conn = getattr( local, 'conn', None )
+
+    if conn != None and local.pid == os.getpid():
+        return conn
+
+    path = getattr( config, 'DB_PATH', 'wpr.db' )
+    timeout = getattr( config, 'DB_BUSY_TIMEOUT', 5000 ) / 1000
+    readOnly = isReadOnly()
+
+    if readOnly:
+        # Any write fails loudly rather than contending with the service
+        conn = sqlite3.connect( 'file:' + urllib.request.pathname2url( os.path.abspath( path ) ) + '?mode=ro', uri=True, timeout=timeout )
+    else:
+        conn = sqlite3.connect( path, timeout=timeout )
+
+    c = conn.cursor()
+
+    if not readOnly:
+        # WAL is stored in the file so read only connections pick it up
+        c.execute( "PRAGMA journal_mode=WAL" )
+        c.execute( "PRAGMA synchronous=NORMAL" )
+
+    c.execute( "PRAGMA busy_timeout=" + str( int( getattr( config, 'DB_BUSY_TIMEOUT', 5000 ) ) ) )
+    c.execute( "PRAGMA cache_size=-" + str( int( getattr( config, 'DB_CACHE_KB', 8192 ) ) ) )
+
+    local.conn = conn
+    local.pid = os.getpid()
+
+    return conn
 
 def initDB():
-    conn = sqlite3.connect( 'wpr.db' )
+    conn = getConnection()
 
     c = conn.cursor()
 
+    # Every gunicorn worker runs this at start up.  All schema work happens in one
+    # transaction holding the write lock so only the first worker creates tables or
+    # migrates and the rest see the result.  Migrating a big database can take
+    # minutes, so wait up to DB_INIT_TIMEOUT seconds for the lock instead of the
+    # usual busy timeout.
+    c.execute( "PRAGMA busy_timeout=" + str( int( getattr( config, 'DB_INIT_TIMEOUT', 600 ) * 1000 ) ) )
+    c.execute( "BEGIN IMMEDIATE" )
+
     # Check to see if jobs table exists and act accordingly
     c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='jobs'" )
 
@@ -12,8 +75,6 @@ def initDB():
         # Table doesn't exist so create
         c.execute( "CREATE TABLE jobs (id integer, pages integer)" )
 
-        conn.commit()
-
     # Check to see if ver table exists and act accordingly
     c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='ver'" )
 
@@ -23,7 +84,82 @@ def initDB():
 
         c.execute( 'INSERT INTO ver VALUES (1)' )
 
-        conn.commit()
+    # Check to see if history table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='history'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Local archive of completed jobs.
+        c.execute( "CREATE TABLE history (id integer PRIMARY KEY, name VARCHAR, user VARCHAR, printer_uri VARCHAR, location VARCHAR, "
+                   "state integer, k_octets integer, pages integer, printed_pages integer, copies integer, sheets integer, "
+                   "time_created integer, time_completed integer)" )
+
+        c.execute( "CREATE INDEX history_time_completed ON history (time_completed, state)" )
+        c.execute( "CREATE INDEX history_location ON history (location, time_completed, state)" )
+        c.execute( "CREATE INDEX history_user ON history (user, time_completed)" )
+
+    # Check to see if sync table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='sync'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Holds watermarks for incremental imports.
+        c.execute( "CREATE TABLE sync (name VARCHAR PRIMARY KEY, value integer)" )
+
+    # Check to see if history_held table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='history_held'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Jobs still active below the history watermark.
+        c.execute( "CREATE TABLE history_held (id integer PRIMARY KEY)" )
+
+    # Check to see if fingerprints table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='fingerprints'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Page counts keyed by document content.
+        c.execute( "CREATE TABLE fingerprints (hash VARCHAR PRIMARY KEY, pages integer, updated integer)" )
+        c.execute( "CREATE INDEX fingerprints_updated ON fingerprints (updated)" )
+
+    # Check to see if stats table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='stats'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Counters shared by all workers.
+        c.execute( "CREATE TABLE stats (name VARCHAR PRIMARY KEY, value integer)" )
+
+    # Check to see if usage table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='usage'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Daily rollup of printed jobs and pages kept
+        # up to date as completed jobs are archived.
+        c.execute( "CREATE TABLE usage (day VARCHAR, location VARCHAR, printer VARCHAR, user VARCHAR, jobs integer, pages integer, "
+                   "PRIMARY KEY (day, location, printer, user))" )
+
+        c.execute( "CREATE INDEX usage_location ON usage (location, day)" )
+
+        # Start from whatever is already archived.  The replace/rtrim pair takes the queue name off the printer URI.
+        c.execute( "INSERT INTO usage (day, location, printer, user, jobs, pages) "
+                   "SELECT date(time_completed, 'unixepoch', 'localtime'), COALESCE(location, 'Unknown'), "
+                   "COALESCE(replace(printer_uri, rtrim(printer_uri, replace(printer_uri, '/', '')), ''), 'Unknown'), "
+                   "COALESCE(user, 'Unknown'), COUNT(*), SUM(COALESCE(printed_pages, 0)) "
+                   "FROM history WHERE state = 9 GROUP BY 1, 2, 3, 4" )
+
+    # Check to see if usage_jobs table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='usage_jobs'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Jobs already added to the usage rollup.  Pruning
+        # the history leaves it alone so a job archived again is never counted twice.
+        c.execute( "CREATE TABLE usage_jobs (id integer PRIMARY KEY)" )
+
+        c.execute( "INSERT INTO usage_jobs (id) SELECT id FROM history WHERE state = 9" )
+
+    # Check to see if claims table exists and act accordingly
+    c.execute( "SELECT name FROM sqlite_master WHERE type='table' AND name='claims'" )
+
+    if c.fetchone() == None:
+        # Table doesn't exist so create.  Jobs a worker is counting pages for right now.
+        c.execute( "CREATE TABLE claims (id integer PRIMARY KEY, owner VARCHAR, expires real)" )
 
     # Version 2 Updates
     c.execute( "SELECT version FROM ver" )
@@ -33,12 +169,220 @@ def initDB():
 
         c.execute( 'UPDATE ver SET version = 2' )
 
-        conn.commit()
+    # Version 3 Updates.  Rebuild jobs with id as the primary key, merging duplicate rows.
+    c.execute( "SELECT version FROM ver" )
+    row = c.fetchone()
+    if row[0] == 2:
+        c.execute( "CREATE TABLE jobs_v3 (id integer PRIMARY KEY, pages integer, location VARCHAR)" )
+
+        c.execute( "INSERT INTO jobs_v3 (id, pages, location) SELECT id, MAX(pages), MAX(location) FROM jobs WHERE id IS NOT NULL GROUP BY id" )
+
+        c.execute( "DROP TABLE jobs" )
+
+        c.execute( "ALTER TABLE jobs_v3 RENAME TO jobs" )
+
+        c.execute( 'UPDATE ver SET version = 3' )
+
+    # Version 4 Updates.  Record when a row was written so old rows can be pruned.
+    c.execute( "SELECT version FROM ver" )
+    row = c.fetchone()
+    if row[0] == 3:
+        c.execute( "ALTER TABLE jobs ADD updated integer" )
+
+        c.execute( "UPDATE jobs SET updated = CAST(strftime('%s','now') AS integer)" )
+
+        c.execute( "CREATE INDEX jobs_updated ON jobs (updated)" )
+
+        c.execute( 'UPDATE ver SET version = 4' )
+
+    # Version 5 Updates.  Carry the job state in the history date indexes so a date window
+    # can be filtered by state and counted from the index alone.
+    c.execute( "SELECT version FROM ver" )
+    row = c.fetchone()
+    if row[0] == 4:
+        c.execute( "DROP INDEX IF EXISTS history_time_completed" )
+        c.execute( "DROP INDEX IF EXISTS history_location" )
+
+        c.execute( "CREATE INDEX history_time_completed ON history (time_completed, state)" )
+        c.execute( "CREATE INDEX history_location ON history (location, time_completed, state)" )
+
+        c.execute( 'UPDATE ver SET version = 5' )
+
+    # Pruning hands pages back with incremental_vacuum, which needs auto_vacuum set
+    # and one full VACUUM to take effect on an existing file.  The 'vacuum' sync mark
+    # claims it so only one worker runs it.
+    c.execute( "PRAGMA auto_vacuum" )
+    vacuum = c.fetchone()[0] != 2
+
+    if vacuum:
+        c.execute( "SELECT value FROM sync WHERE name='vacuum'" )
+        row = c.fetchone()
+
+        now = int( time.time() )
+
+        if row != None and row[0] != None and now - row[0] < getattr( config, 'DB_INIT_TIMEOUT', 600 ):
+            # Another worker is on it
+            vacuum = False
+        else:
+            c.execute( "INSERT OR REPLACE INTO sync (name, value) VALUES ('vacuum', ?)", ( now, ) )
+
+    conn.commit()
+
+    if vacuum:
+        c.execute( "PRAGMA auto_vacuum=INCREMENTAL" )
+        c.execute( "VACUUM" )
+
+    c.execute( "PRAGMA busy_timeout=" + str( int( getattr( config, 'DB_BUSY_TIMEOUT', 5000 ) ) ) )
+
+# Write-behind buffer for page counts and locations.  Writes are merged per job and
+# committed together every WRITE_BEHIND_MS milliseconds or once WRITE_BEHIND_ITEMS
+# jobs are waiting.  A flush moves the buffer to flushingWrites and writes it without
+# holding pendingLock.  Reads look in both first so a pending write is never missed.
+pendingWrites = {}
+flushingWrites = {}
+pendingLock = threading.Lock()
+flushLock = threading.Lock()
+pendingFlush = { 'thread': None, 'wake': threading.Event(), 'pid': os.getpid() }
+
+def lookupPendingWrite( job_id ):
+    """Buffered (pages, location) for a job or None.  Caller holds pendingLock."""
+    if job_id not in pendingWrites and job_id not in flushingWrites:
+        return None
+
+    pages, location = pendingWrites.get( job_id, ( None, None ) )
+    flushing_pages, flushing_location = flushingWrites.get( job_id, ( None, None ) )
+
+    return ( pages if pages != None else flushing_pages,
+             location if location != None else flushing_location )
+
+def getPendingJobInfo( job_id ):
+    """Pending (pages, location) for a job or None"""
+    with pendingLock:
+        return lookupPendingWrite( job_id )
+
+def mergePendingWrite( job_id, pages, location ):
+    """Fold a write into the buffer.  Caller holds pendingLock."""
+    old_pages, old_location = pendingWrites.get( job_id, ( None, None ) )
+
+    pendingWrites[job_id] = ( pages if pages != None else old_pages,
+                              location if location != None else old_location )
+
+def flushLoop( wake ):
+    """Commit the buffer WRITE_BEHIND_MS after a write wakes us.  One thread per
+       process does every timed flush so they all share its connection.
+    """
+    while True:
+        wake.wait()
+        time.sleep( getattr( config, 'WRITE_BEHIND_MS', 200 ) / 1000 )
+        wake.clear()
+
+        try:
+            flushDbWrites()
+        except Exception:
+            # The rows stay buffered and go with the next flush
+            pass
 
-    conn.close()
+def queueDbJobInfo( job_id, pages, location ):
+    """Buffer a page count and/or location write.  None leaves a value alone."""
+    with pendingLock:
+        if pendingFlush['pid'] != os.getpid():
+            # Forked.  The parent's flush thread didn't come with us.
+            pendingFlush['thread'] = None
+            pendingFlush['wake'] = threading.Event()
+            pendingFlush['pid'] = os.getpid()
+
+        mergePendingWrite( job_id, pages, location )
+
+        full = len( pendingWrites ) >= getattr( config, 'WRITE_BEHIND_ITEMS', 100 )
+
+        if not full:
+            if pendingFlush['thread'] == None:
+                pendingFlush['thread'] = threading.Thread( target=flushLoop, args=( pendingFlush['wake'], ), name='dbflush', daemon=True )
+                pendingFlush['thread'].start()
+
+            pendingFlush['wake'].set()
+
+    if full:
+        flushDbWrites()
+
+def flushDbWrites():
+    """Commit all buffered writes in one transaction"""
+    global flushingWrites
+
+    # One flush at a time.  Writers and readers only wait for pendingLock, which is
+    # never held while sqlite writes.
+    with flushLock:
+        with pendingLock:
+            if not pendingWrites:
+                return
+
+            flushingWrites = dict( pendingWrites )
+            pendingWrites.clear()
+
+        rows = [ ( job_id, pages, location ) for job_id, ( pages, location ) in flushingWrites.items() ]
+
+        try:
+            conn = getConnection()
+
+            # Commits at the end of the block or rolls back if anything fails
+            with conn:
+                conn.executemany( "INSERT INTO jobs (id, pages, location, updated) VALUES (?,?,?,CAST(strftime('%s','now') AS integer)) "
+                                  "ON CONFLICT(id) DO UPDATE SET pages = COALESCE(excluded.pages, pages), location = COALESCE(excluded.location, location), updated = excluded.updated",
+                                  rows )
+        except BaseException:
+            # Put the rows back under anything written since so the next flush retries them
+            with pendingLock:
+                newer = dict( pendingWrites )
+
+                pendingWrites.clear()
+                pendingWrites.update( flushingWrites )
+
+                for job_id, ( pages, location ) in newer.items():
+                    mergePendingWrite( job_id, pages, location )
+
+                flushingWrites = {}
+
+            raise
+
+        with pendingLock:
+            flushingWrites = {}
+
+# Don't lose buffered writes when a worker shuts down
+atexit.register( flushDbWrites )
+
+# Stored as a job's page count when counting it failed, so it isn't fetched and parsed
+# again on every job list refresh
+pagesUnknown = -1
+
+def getDbCountFailure( job_id ):
+    """When counting a job last failed, as epoch seconds.  None if it hasn't failed."""
+    pending = getPendingJobInfo( job_id )
+
+    if pending != None and pending[0] != None:
+        return time.time() if pending[0] == pagesUnknown else None
+
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( "SELECT updated FROM jobs WHERE id=? AND pages=?", ( job_id, pagesUnknown ) )
+
+    row = c.fetchone()
+
+    if row == None:
+        result = None
+    else:
+        result = row[0] or 0
+
+    return result
 
 def getDbPageCount( job_id ):
-    conn = sqlite3.connect( 'wpr.db' )
+    pending = getPendingJobInfo( job_id )
+
+    if pending != None and pending[0] != None:
+        return pending[0]
+
+    conn = getConnection()
 
     c = conn.cursor()
 
@@ -46,8 +390,6 @@ def getDbPageCount( job_id ):
 
     row = c.fetchone()
 
-    conn.close()
-
     if row == None:
         result = None
     else:
@@ -56,7 +398,12 @@ def getDbPageCount( job_id ):
     return result
 
 def getDbJobLocation( job_id ):
-    conn = sqlite3.connect( 'wpr.db' )
+    pending = getPendingJobInfo( job_id )
+
+    if pending != None and pending[1] != None:
+        return pending[1]
+
+    conn = getConnection()
 
     c = conn.cursor()
 
@@ -64,8 +411,6 @@ def getDbJobLocation( job_id ):
 
     row = c.fetchone()
 
-    conn.close()
-
     if row == None:
         result = None
     else:
@@ -74,26 +419,460 @@ def getDbJobLocation( job_id ):
     return result
 
 def putDbPageCount( job_id, pages ):
-    conn = sqlite3.connect( 'wpr.db' )
+    queueDbJobInfo( job_id, pages, None )
+
+    return
+
+def putDbJobLocation( job_id, location ):
+    queueDbJobInfo( job_id, None, location )
+
+    return
+
+def getDbJobInfo( job_ids ):
+    """Get stored page counts and locations for many jobs in one query.
+
+       Returns {job_id: (pages, location)} for the ids found.
+    """
+    result = {}
+
+    if not job_ids:
+        return result
+
+    # Copy buffered writes before reading the table.  A flush that lands in between
+    # has committed them, so the read below still sees them.
+    with pendingLock:
+        pending = { job_id: lookupPendingWrite( job_id ) for job_id in job_ids if job_id in pendingWrites or job_id in flushingWrites }
+
+    conn = getConnection()
 
     c = conn.cursor()
 
-    c.execute( 'INSERT INTO jobs (id, pages) VALUES (?,?)', ( job_id, pages ) )
+    # Pass the ids as one JSON array so any number of jobs costs a single query
+    c.execute( "SELECT id, pages, location FROM jobs WHERE id IN (SELECT value FROM json_each(?))",
+               ( json.dumps( list( job_ids ) ), ) )
 
-    conn.commit()
-    conn.close()
+    for row in c.fetchall():
+        result[row[0]] = ( row[1], row[2] )
+
+    # Buffered writes win over what is on disk
+    for job_id, ( pending_pages, pending_location ) in pending.items():
+        pages, location = result.get( job_id, ( None, None ) )
+        result[job_id] = ( pending_pages if pending_pages != None else pages,
+                           pending_location if pending_location != None else location )
+
+    return result
+
+def putDbJobInfo( rows ):
+    """Store page counts and locations for many jobs in one transaction.
+
+       rows is a list of (job_id, pages, location).  None leaves a stored value alone.
+       Anything already buffered is committed in the same transaction.
+    """
+    if not rows:
+        return
+
+    with pendingLock:
+        for job_id, pages, location in rows:
+            mergePendingWrite( job_id, pages, location )
+
+    flushDbWrites()
 
     return
 
-def putDbJobLocation( job_id, location ):
-    conn = sqlite3.connect( 'wpr.db' )
+def claimOwner():
+    return os.uname().nodename + ':' + str( os.getpid() ) + ':' + str( threading.get_ident() )
+
+def claimDbJob( job_id, lease ):
+    """Claim a job for page counting for lease seconds.  Returns False while another
+       worker holds a claim that hasn't expired.  Expired claims are taken over so a
+       crashed worker's jobs get counted again.
+    """
+    conn = getConnection()
+
+    now = time.time()
+
+    # One statement so two workers can't both win
+    with conn:
+        c = conn.execute( "INSERT INTO claims (id, owner, expires) VALUES (?,?,?) "
+                          "ON CONFLICT(id) DO UPDATE SET owner = excluded.owner, expires = excluded.expires WHERE claims.expires < ?",
+                          ( job_id, claimOwner(), now + lease, now ) )
+
+    return c.rowcount == 1
+
+def releaseDbJob( job_id ):
+    """Give up our claim on a job.  Buffered page counts are written first so the
+       next worker to look sees the result rather than counting again.
+    """
+    flushDbWrites()
+
+    conn = getConnection()
+
+    with conn:
+        conn.execute( "DELETE FROM claims WHERE id=? AND owner=?", ( job_id, claimOwner() ) )
+
+def getDbFingerprint( fingerprint ):
+    """Get the page count stored for a document fingerprint or None"""
+    conn = getConnection()
 
     c = conn.cursor()
 
-    c.execute( 'UPDATE jobs SET location = ? WHERE id = ?', ( location, job_id ) )
+    c.execute( "SELECT pages FROM fingerprints WHERE hash=?", (fingerprint,) )
 
-    conn.commit()
-    conn.close()
+    row = c.fetchone()
+
+    if row == None:
+        result = None
+    else:
+        result = row[0]
+
+    return result
+
+def putDbFingerprint( fingerprint, pages ):
+    conn = getConnection()
+
+    with conn:
+        conn.execute( "INSERT OR REPLACE INTO fingerprints (hash, pages, updated) VALUES (?,?,CAST(strftime('%s','now') AS integer))",
+                      ( fingerprint, pages ) )
+
+    return
+
+def bumpDbStat( name, amount=1 ):
+    """Add to a shared counter"""
+    conn = getConnection()
+
+    with conn:
+        conn.execute( "INSERT INTO stats (name, value) VALUES (?,?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                      ( name, amount ) )
+
+    return
+
+def getDbStats():
+    """All shared counters as {name: value}"""
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( "SELECT name, value FROM stats" )
+
+    return dict( c.fetchall() )
+
+# History columns and the job attribute each one holds
+historyColumns = [ ( 'id', 'job-id' ),
+                   ( 'name', 'job-name' ),
+                   ( 'user', 'job-originating-user-name' ),
+                   ( 'printer_uri', 'job-printer-uri' ),
+                   ( 'location', 'job-printer-location' ),
+                   ( 'state', 'job-state' ),
+                   ( 'k_octets', 'job-k-octets' ),
+                   ( 'pages', 'page-count' ),
+                   ( 'printed_pages', 'printed-pages' ),
+                   ( 'copies', 'copies' ),
+                   ( 'sheets', 'job-media-sheets-completed' ),
+                   ( 'time_created', 'time-at-creation' ),
+                   ( 'time_completed', 'time-at-completed' )
+                 ]
+
+def bumpHistoryVersion( c ):
+    """Move the 'history-version' sync mark on so cached history pages go stale"""
+    c.execute( "INSERT OR REPLACE INTO sync (name, value) VALUES ('history-version', ?)", ( time.time_ns() // 1000, ) )
+
+def putDbHistory( jobs ):
+    """Add or update completed jobs in the history archive in one transaction.
+
+       Jobs in state 9 (completed) that aren't in usage_jobs yet are added to the
+       usage rollup and to usage_jobs in the same transaction so each one is
+       counted exactly once, even if it is archived again after being pruned.
+    """
+    if not jobs:
+        return
+
+    conn = getConnection()
+
+    with conn:
+        c = conn.cursor()
+
+        # Take the write lock before looking for known jobs.  Otherwise two workers
+        # archiving the same jobs can both see them as new and both count them.
+        c.execute( "BEGIN IMMEDIATE" )
+
+        ids = json.dumps( [ job['job-id'] for job in jobs ] )
+
+        c.execute( "SELECT id FROM history WHERE id IN (SELECT value FROM json_each(?))", ( ids, ) )
+        known = set( row[0] for row in c.fetchall() )
+
+        c.execute( "SELECT id FROM usage_jobs WHERE id IN (SELECT value FROM json_each(?))", ( ids, ) )
+        counted = set( row[0] for row in c.fetchall() )
+
+        rollup = []
+        newlyCounted = []
+        for job in jobs:
+            if job['job-id'] in counted or job.get( 'job-state' ) != 9:
+                continue
+
+            counted.add( job['job-id'] )
+            newlyCounted.append( ( job['job-id'], ) )
+
+            uri = job.get( 'job-printer-uri' ) or 'Unknown'
+
+            rollup.append( ( job.get( 'time-at-completed' ) or 0,
+                             job.get( 'job-printer-location' ) or 'Unknown',
+                             uri[uri.rfind( '/' ) + 1:],
+                             job.get( 'job-originating-user-name' ) or 'Unknown',
+                             job.get( 'printed-pages' ) or 0 ) )
+
+        conn.executemany( "INSERT INTO usage (day, location, printer, user, jobs, pages) VALUES (date(?, 'unixepoch', 'localtime'), ?, ?, ?, 1, ?) "
+                          "ON CONFLICT(day, location, printer, user) DO UPDATE SET jobs = jobs + 1, pages = pages + excluded.pages",
+                          rollup )
+
+        conn.executemany( "INSERT INTO usage_jobs (id) VALUES (?)", newlyCounted )
+
+        if len( known ) < len( jobs ):
+            bumpHistoryVersion( c )
+
+        conn.executemany( 'INSERT OR REPLACE INTO history (' + ', '.join( col for col, key in historyColumns ) + ') VALUES (' + ','.join( '?' * len( historyColumns ) ) + ')',
+                          [ tuple( job.get( key ) for col, key in historyColumns ) for job in jobs ] )
 
     return
-    
+
+def getDbHistory( start, end, location='all', states=None, sort='time-at-completed', sort_order='desc', offset=0, limit=100, stream=False ):
+    """Get one page of the history archive.
+
+       start and end are epoch seconds.  Rows come back as job dicts using the
+       CUPS attribute names.  Returns (jobs, total matching rows).  With stream
+       jobs is a generator that reads rows from the database as it is consumed.
+    """
+    sortColumns = { key: col for col, key in historyColumns }
+
+    where = 'time_completed > ? AND time_completed < ?'
+    params = [ int( start ), int( end ) ]
+
+    if location != 'all':
+        where += ' AND location = ?'
+        params.append( location )
+
+    if states:
+        where += ' AND state IN (' + ','.join( '?' * len( states ) ) + ')'
+        params += list( states )
+
+    # Ties go the same way as the sort so a date ordered page is read straight off
+    # the index and stops after limit rows instead of sorting the whole window
+    direction = ' ASC' if sort_order == 'asc' else ' DESC'
+    order = sortColumns.get( sort, 'time_completed' ) + direction + ', id' + direction
+
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( 'SELECT COUNT(*) FROM history WHERE ' + where, params )
+    total = c.fetchone()[0]
+
+    sql = 'SELECT ' + ', '.join( col for col, key in historyColumns ) + ' FROM history WHERE ' + where + ' ORDER BY ' + order + ' LIMIT ? OFFSET ?'
+
+    if stream:
+        return iterDbRows( sql, params + [ limit, offset ] ), total
+
+    c.execute( sql, params + [ limit, offset ] )
+
+    result = [ { key: row[i] for i, ( col, key ) in enumerate( historyColumns ) } for row in c.fetchall() ]
+
+    return result, total
+
+def iterDbRows( sql, params, batch=200 ):
+    """Yield history rows as job dicts a batch at a time"""
+    c = getConnection().cursor()
+
+    try:
+        c.execute( sql, params )
+
+        while True:
+            rows = c.fetchmany( batch )
+
+            if not rows:
+                break
+
+            for row in rows:
+                yield { key: row[i] for i, ( col, key ) in enumerate( historyColumns ) }
+    finally:
+        c.close()
+
+def getDbUsage( start_day, end_day, period='day', group='location', location='all' ):
+    """Sum the usage rollup between two 'YYYY-MM-DD' days inclusive.
+
+       period is day, month or year.  group is location, printer, user or none.
+       Returns a list of (period, group value, jobs, pages) ordered by period.
+    """
+    periods = { 'day': 'day', 'month': 'substr(day, 1, 7)', 'year': 'substr(day, 1, 4)' }
+    groups = { 'location': 'location', 'printer': 'printer', 'user': 'user', 'none': "''" }
+
+    periodExpr = periods.get( period, 'day' )
+    groupExpr = groups.get( group, 'location' )
+
+    where = 'day BETWEEN ? AND ?'
+    params = [ start_day, end_day ]
+
+    if location != 'all':
+        where += ' AND location = ?'
+        params.append( location )
+
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( 'SELECT ' + periodExpr + ', ' + groupExpr + ', SUM(jobs), SUM(pages) FROM usage WHERE ' + where +
+               ' GROUP BY 1, 2 ORDER BY 1, 2', params )
+
+    return c.fetchall()
+
+def getDbSyncMark( name ):
+    """Get a sync watermark.  None if it was never set."""
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( "SELECT value FROM sync WHERE name=?", (name,) )
+
+    row = c.fetchone()
+
+    if row == None:
+        result = None
+    else:
+        result = row[0]
+
+    return result
+
+def putDbSyncMark( name, value ):
+    conn = getConnection()
+
+    with conn:
+        conn.execute( 'INSERT OR REPLACE INTO sync (name, value) VALUES (?,?)', ( name, value ) )
+
+    return
+
+def getDbHistoryHeld():
+    """Ids of the jobs that were still active below the history watermark at the last sync"""
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( "SELECT id FROM history_held" )
+
+    return [ row[0] for row in c.fetchall() ]
+
+def putDbHistoryMark( mark, held ):
+    """Move the 'history' watermark on to mark and replace the held job ids in one transaction"""
+    conn = getConnection()
+
+    with conn:
+        conn.execute( "INSERT OR REPLACE INTO sync (name, value) VALUES ('history', ?)", ( mark, ) )
+        conn.execute( "DELETE FROM history_held" )
+        conn.executemany( "INSERT INTO history_held (id) VALUES (?)", ( ( job_id, ) for job_id in held ) )
+
+    return
+
+def claimDbMaintenance( interval ):
+    """Claim the next maintenance run.  Returns False if another worker ran one
+       within the last interval seconds.
+    """
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( "BEGIN IMMEDIATE" )
+
+    try:
+        c.execute( "SELECT value FROM sync WHERE name='maintenance'" )
+        row = c.fetchone()
+
+        now = int( time.time() )
+
+        if row != None and row[0] != None and now - row[0] < interval:
+            return False
+
+        c.execute( "INSERT OR REPLACE INTO sync (name, value) VALUES ('maintenance', ?)", ( now, ) )
+
+        return True
+    finally:
+        conn.commit()
+
+def pruneDb( days=None, keep_jobs=None, history_days=None, batch=500, vacuum_pages=256 ):
+    """Delete old rows in small batches and give the free pages back to the file system.
+
+       Page counts and fingerprints older than days, or page counts more than keep_jobs job ids behind the newest,
+       are removed.  History rows completed more than history_days ago are removed.
+       Expired page count claims are always removed.
+       None turns a rule off.  Returns {'rows': rows removed, 'bytes': bytes reclaimed}.
+    """
+    conn = getConnection()
+
+    c = conn.cursor()
+
+    c.execute( "PRAGMA page_size" )
+    page_size = c.fetchone()[0]
+
+    c.execute( "PRAGMA page_count" )
+    pages_before = c.fetchone()[0]
+
+    # ( batch delete, value for its first parameter, True if it removes history rows )
+    rules = [ ( "DELETE FROM claims WHERE id IN (SELECT id FROM claims WHERE expires < ? LIMIT ?)", time.time(), False ) ]
+
+    if days != None:
+        rules.append( ( "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE updated < ? LIMIT ?)",
+                        int( time.time() - days * 86400 ), False ) )
+        rules.append( ( "DELETE FROM fingerprints WHERE hash IN (SELECT hash FROM fingerprints WHERE updated < ? LIMIT ?)",
+                        int( time.time() - days * 86400 ), False ) )
+
+    if keep_jobs != None:
+        c.execute( "SELECT MAX(id) FROM jobs" )
+        newest = c.fetchone()[0]
+
+        if newest != None:
+            rules.append( ( "DELETE FROM jobs WHERE id IN (SELECT id FROM jobs WHERE id <= ? LIMIT ?)",
+                            newest - keep_jobs, False ) )
+
+    if history_days != None:
+        rules.append( ( "DELETE FROM history WHERE id IN (SELECT id FROM history WHERE time_completed < ? LIMIT ?)",
+                        int( time.time() - history_days * 86400 ), True ) )
+
+    removed = 0
+
+    for sql, value, history in rules:
+        while True:
+            # One short transaction per batch so page loads never wait long for the lock
+            with conn:
+                c.execute( sql, ( value, batch ) )
+                count = c.rowcount
+
+                if count and history:
+                    bumpHistoryVersion( c )
+
+            removed += count
+
+            if count < batch:
+                break
+
+    # Release free pages a few at a time for the same reason
+    c.execute( "PRAGMA freelist_count" )
+    free = c.fetchone()[0]
+
+    while free > 0:
+        c.execute( "PRAGMA incremental_vacuum(" + str( int( vacuum_pages ) ) + ")" )
+        c.fetchall()
+
+        c.execute( "PRAGMA freelist_count" )
+        left = c.fetchone()[0]
+
+        if left >= free:
+            # auto_vacuum isn't incremental so nothing can be reclaimed
+            break
+
+        free = left
+
+    c.execute( "PRAGMA page_count" )
+    pages_after = c.fetchone()[0]
+
+    return { 'rows': removed, 'bytes': ( pages_before - pages_after ) * page_size }
+
+if __name__ == '__main__':
+    # Create or migrate wpr.db before the web workers start
+    ownsDb = True
+    initDB()
@@ -0,0 +1,125 @@
+import os
+import queue
+import threading
+import time
+
+class Subscriber:
+    """One connected terminal.  Events for other locations are never queued."""
+    def __init__(self, location, limit):
+        self.location = location
+        self.events = queue.Queue( limit )
+        self.overflow = False
+
+    def put(self, events):
+        try:
+            self.events.put_nowait( events )
+        except queue.Full:
+            # Too far behind.  It gets the whole list again instead.
+            self.overflow = True
+
+    def get(self, timeout):
+        """Next list of (event, job or job id, version).  Empty if nothing happened
+           within timeout seconds.
+        """
+        if self.overflow:
+            self.overflow = False
+
+            return [ ( 'reset', None, None ) ]
+
+        try:
+            return self.events.get( timeout=timeout )
+        except queue.Empty:
+            return []
+
+class JobEventHub:
+    """Turns job list versions into job-added, job-state-changed and job-removed
+       events for every connected terminal.
+
+       A single producer thread per process watches the state returned by
+       getState and asks getChanges what happened since the version it last saw.
+       It runs only while someone is subscribed.
+    """
+    def __init__(self, getState, getChanges, interval=2, limit=100):
+        self.getState = getState
+        self.getChanges = getChanges
+        self.interval = interval
+        self.limit = limit
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.thread = None
+
+    def subscribe(self, location):
+        if self.pid != os.getpid():
+            self.reset()
+
+        subscriber = Subscriber( location, self.limit )
+
+        with self.lock:
+            self.subscribers.append( subscriber )
+
+            if self.thread == None:
+                self.thread = threading.Thread( target=self.run, name='jobevents', daemon=True )
+                self.thread.start()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove( subscriber )
+
+    def publish(self, changes, version):
+        """Hand each subscriber the events for its location"""
+        with self.lock:
+            subscribers = list( self.subscribers )
+
+        for subscriber in subscribers:
+            if changes == None:
+                subscriber.put( [ ( 'reset', None, version ) ] )
+                continue
+
+            events = []
+
+            for job in changes['added']:
+                if subscriber.location == 'all' or job['job-printer-location'] == subscriber.location:
+                    events.append( ( 'job-added', job, version ) )
+
+            for job in changes['changed']:
+                if subscriber.location == 'all' or job['job-printer-location'] == subscriber.location:
+                    events.append( ( 'job-state-changed', job, version ) )
+                else:
+                    # May have moved away from this location
+                    events.append( ( 'job-removed', job['job-id'], version ) )
+
+            for job_id in changes['removed']:
+                events.append( ( 'job-removed', job_id, version ) )
+
+            if events:
+                subscriber.put( events )
+
+    def run(self):
+        version = None
+
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+
+            try:
+                state = self.getState()
+            except Exception:
+                # CUPS trouble.  Try again next time round.
+                state = None
+
+            if state != None:
+                if version != None and state['version'] != version:
+                    self.publish( self.getChanges( state, version ), state['version'] )
+
+                version = state['version']
+
+            time.sleep( self.interval )
@@ -0,0 +1,161 @@
+import threading
+from datetime import datetime
+from jinja2.filters import do_filesizeformat
+
+jobStates = { 3: 'Pending',
+              4: 'Held',
+              5: 'Printing',
+              6: 'Stopped',
+              7: 'Canceled',
+              8: 'Aborted: Error',
+              9: 'Completed'
+            }
+
+def isNumber( s ):
+    try:
+        float( s )
+        return True
+    except:
+        return False
+
+def formatTime( value, format='%Y/%m/%d %I:%M %p' ):
+    """Epoch seconds as local time.  Anything else is returned as is."""
+    if isNumber( value ):
+        return datetime.fromtimestamp( int( value ) ).strftime( format )
+
+    return value
+
+def stateName( value ):
+    return jobStates.get( value, 'Unknown' )
+
+def queueName( uri ):
+    """Queue name from a printer URI"""
+    return uri[uri.rfind( '/' ) + 1:]
+
+def truncate( s, length, killwords=False ):
+    """Same as the jinja truncate filter"""
+    s = str( s )
+
+    if len( s ) <= length + 5:
+        return s
+
+    s = s[:length - 3]
+
+    if not killwords:
+        s = s.rsplit( ' ', 1 )[0]
+
+    return s + '...'
+
+def sortKey( value ):
+    """Comparable key for any attribute value.  Missing values sort first, then
+       numbers, then text ignoring case.
+    """
+    if value == None:
+        return ( 0, 0 )
+
+    if isinstance( value, ( int, float ) ):
+        return ( 1, value )
+
+    return ( 2, str( value ).casefold() )
+
+# Sortable job list columns and the record attribute holding each one
+sortColumns = { 'job-originating-user-name': 'user',
+                'job-name': 'name',
+                'job-printer-uri': 'printer_uri',
+                'job-k-octets': 'k_octets',
+                'page-count': 'page_count',
+                'time-at-creation': 'created'
+              }
+
+sortOrder = list( sortColumns )
+
+class JobRecord:
+    """One active job as the job list shows it.
+
+       Built once per snapshot version with sort keys and display strings worked
+       out up front, so sorting never trips over a missing attribute and the
+       template doesn't format every cell on every render.
+    """
+    __slots__ = ( 'id', 'user', 'name', 'printer_uri', 'location', 'state', 'k_octets', 'page_count', 'copies',
+                  'pending', 'failed', 'created', 'keys', 'user_text', 'name_text', 'queue_text', 'size_text', 'pages_text',
+                  'created_text', 'state_text' )
+
+    def __init__(self, job):
+        self.id = job['job-id']
+        self.user = job.get( 'job-originating-user-name', '' )
+        self.name = job.get( 'job-name', '' )
+        self.printer_uri = job.get( 'job-printer-uri', '' )
+        self.location = job.get( 'job-printer-location' )
+        self.state = job.get( 'job-state', 0 )
+        self.k_octets = job.get( 'job-k-octets', 0 )
+        self.page_count = job.get( 'page-count', 0 )
+        self.copies = job.get( 'copies', 1 )
+        self.pending = bool( job.get( 'page-count-pending' ) )
+        self.failed = bool( job.get( 'page-count-failed' ) )
+        self.created = job.get( 'time-at-creation' )
+
+        self.keys = tuple( sortKey( getattr( self, sortColumns[column] ) ) for column in sortOrder )
+
+        self.user_text = truncate( self.user, 12 )
+        self.name_text = truncate( self.name, 25, True )
+        self.queue_text = truncate( queueName( self.printer_uri ), 20, True )
+        self.size_text = do_filesizeformat( self.k_octets * 1024 )
+        self.pages_text = str( ( self.page_count or 0 ) * self.copies )
+        self.created_text = formatTime( self.created if self.created != None else 'None' )
+        self.state_text = stateName( self.state )
+
+    def columnKey(self, column):
+        """The key a column sorts on as [kind, value], the way JobList orders it.
+           Unknown columns sort by user.
+        """
+        if column not in sortColumns:
+            column = 'job-originating-user-name'
+
+        return list( self.keys[sortOrder.index( column )] )
+
+    def columnKeys(self):
+        """Every sortable column's key as {column: [kind, value]}"""
+        return { column: list( self.keys[i] ) for i, column in enumerate( sortOrder ) }
+
+    def display(self):
+        """The strings the job list shows, so rows added by jobs.js match rendered ones"""
+        return { 'user': self.user_text,
+                 'name': self.name_text,
+                 'queue': self.queue_text,
+                 'size': self.size_text,
+                 'pages': self.pages_text,
+                 'created': self.created_text,
+                 'state': self.state_text
+               }
+
+class JobList:
+    """The job records for one snapshot version.  Each ordering is sorted once
+       and reused until the next version.
+    """
+    def __init__(self, version, jobs):
+        self.version = version
+        self.records = [ JobRecord( job ) for job in jobs ]
+        self.byId = { record.id: record for record in self.records }
+        self.orderings = {}
+        self.lock = threading.Lock()
+
+    def ordered(self, sort, sort_order):
+        """Records sorted by a column, job id breaking ties.  Unknown columns sort by user.
+           The list is shared so callers must not change it.
+        """
+        if sort not in sortColumns:
+            sort = 'job-originating-user-name'
+
+        reverse = sort_order != 'asc'
+
+        with self.lock:
+            ordering = self.orderings.get( ( sort, reverse ) )
+
+        if ordering == None:
+            i = sortOrder.index( sort )
+            ordering = sorted( self.records, key=lambda r: ( r.keys[i], r.id ), reverse=reverse )
+
+            with self.lock:
+                self.orderings[( sort, reverse )] = ordering
+
+        return ordering
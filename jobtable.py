@@ -0,0 +1,211 @@
+import cups
+import os
+import threading
+import time
+import config
+from cupspool import cupsCall
+
+# Attributes kept for each active job.  'All' was sometimes returning partial result sets.
+jobAttributes = ["job-id",
+                 "job-name",
+                 "job-state",
+                 "job-printer-uri",
+                 "job-originating-user-name",
+                 "job-k-octets",
+                 "time-at-creation",
+                 "job-media-sheets-completed",
+                 "time-at-completed",
+                 "Duplex",
+                 "copies"
+                ]
+
+jobEvents = ['job-created', 'job-state-changed', 'job-completed']
+
+class JobTable:
+    """In-memory table of not-completed jobs kept current by CUPS notifications.
+
+       A pull (ippget) subscription is created for job events.  Each poll asks
+       CUPS only for events since the last one seen and refreshes the jobs they
+       name.  A full getJobs() resync happens at start up, when the subscription
+       is lost, when a gap in the sequence numbers shows events were dropped, when
+       a job named by an event couldn't be fetched and every resync_interval
+       seconds in case CUPS dropped an event without a gap.
+
+       conn is any object with the pycups Connection methods.  Without one the
+       shared connection pool is used.
+    """
+    def __init__(self, conn=None, interval=5, lease=3600, burst=50, resync_interval=300):
+        self.conn = conn
+        self.interval = interval
+        self.lease = lease
+        self.burst = burst
+        self.resyncInterval = resync_interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything.  Also used after a fork since subscriptions belong to one process."""
+        self.pid = os.getpid()
+        self.jobs = {}
+        self.subscription = None
+        self.sequence = 1
+        self.renewAt = 0
+        self.retryAt = 0
+        self.nextPoll = 0
+        self.resyncAt = 0
+        self.synced = False
+        self.resyncs = 0
+
+    def call(self, method, *args, **kwargs):
+        if self.conn == None:
+            return cupsCall( method, *args, **kwargs )
+
+        return getattr( self.conn, method )( *args, **kwargs )
+
+    def resync(self):
+        """Replace the table with a full getJobs() listing"""
+        jobs = self.call( 'getJobs',
+                          which_jobs='not-completed',
+                          my_jobs=False,
+                          limit=-1,
+                          first_job_id=-1,
+                          requested_attributes=jobAttributes )
+
+        for k, v in jobs.items():
+            v['job-id'] = k
+
+        self.jobs = jobs
+        self.synced = True
+        self.resyncs += 1
+        self.resyncAt = time.monotonic() + self.resyncInterval
+
+    def subscribe(self):
+        """Create the job event subscription.  Returns False if CUPS won't allow one."""
+        try:
+            self.subscription = self.call( 'createSubscription', 'ipp://localhost/',
+                                           events=jobEvents,
+                                           lease_duration=self.lease )
+        except (RuntimeError, cups.IPPError):
+            # Try again in a while
+            self.subscription = None
+            self.retryAt = time.monotonic() + self.lease / 12
+            return False
+
+        self.sequence = 1
+        self.renewAt = time.monotonic() + self.lease / 2
+
+        return True
+
+    def renew(self):
+        if time.monotonic() < self.renewAt:
+            return
+
+        self.call( 'renewSubscription', self.subscription, lease_duration=self.lease )
+        self.renewAt = time.monotonic() + self.lease / 2
+
+    def refreshJob(self, job_id):
+        """Reload one job's attributes or drop it once it has finished"""
+        try:
+            job = self.call( 'getJobAttributes', job_id=job_id, requested_attributes=jobAttributes )
+        except cups.IPPError:
+            # Purged from CUPS
+            self.jobs.pop( job_id, None )
+            return
+
+        if job.get( 'job-state', 0 ) >= 7:
+            self.jobs.pop( job_id, None )
+        else:
+            job['job-id'] = job_id
+            self.jobs[job_id] = job
+
+    def applyEvents(self, events):
+        """Apply a batch of notifications.  Returns False if a resync is needed instead.
+
+           The sequence number only moves past the batch once every job it names has
+           been refreshed, so an exception leaves the events to be fetched again.
+        """
+        if events and events[0].get( 'notify-sequence-number', self.sequence ) > self.sequence:
+            # Events were dropped before we fetched them
+            return False
+
+        sequence = self.sequence
+        changed = []
+        for event in events:
+            sequence = event.get( 'notify-sequence-number', sequence ) + 1
+            job_id = event.get( 'notify-job-id' )
+
+            if job_id == None:
+                continue
+
+            if event.get( 'notify-subscribed-event' ) == 'job-completed' or event.get( 'job-state', 0 ) >= 7:
+                self.jobs.pop( job_id, None )
+            elif job_id not in changed:
+                changed.append( job_id )
+
+        if len( changed ) > self.burst:
+            # Cheaper to list everything than fetch each job
+            return False
+
+        for job_id in changed:
+            self.refreshJob( job_id )
+
+        self.sequence = sequence
+
+        return True
+
+    def poll(self):
+        """Bring the table up to date with CUPS"""
+        if self.pid != os.getpid():
+            self.reset()
+
+        if self.subscription == None and ( time.monotonic() < self.retryAt or not self.subscribe() ):
+            # No notifications available so fall back to a full listing every time
+            self.resync()
+            return
+
+        if not self.synced or time.monotonic() >= self.resyncAt:
+            self.resync()
+            return
+
+        try:
+            self.renew()
+            notifications = self.call( 'getNotifications', [self.subscription], sequence_numbers=[self.sequence] )
+        except cups.IPPError:
+            # Subscription expired or was cancelled
+            self.subscription = None
+            self.synced = False
+            self.poll()
+            return
+
+        events = notifications.get( 'events', [] )
+
+        try:
+            applied = self.applyEvents( events )
+        except Exception:
+            # A job couldn't be refreshed, e.g. the CUPS call timed out.  List everything
+            # on the next poll rather than lose its update.
+            self.synced = False
+            raise
+
+        if not applied:
+            self.resync()
+
+            # The listing covers these events
+            self.sequence = events[-1].get( 'notify-sequence-number', self.sequence ) + 1
+
+    def expire(self):
+        """Make the next read poll CUPS straight away, e.g. after releasing a job"""
+        with self.lock:
+            self.nextPoll = 0
+
+    def getJobs(self):
+        """Get a copy of the table as {job-id: attributes}, polling if due"""
+        with self.lock:
+            if time.monotonic() >= self.nextPoll or self.pid != os.getpid():
+                self.poll()
+                self.nextPoll = time.monotonic() + self.interval
+
+            return { k: dict( v ) for k, v in self.jobs.items() }
+
+jobTable = JobTable( interval=getattr( config, 'JOB_POLL_INTERVAL', 5 ),
+                     lease=getattr( config, 'JOB_SUBSCRIPTION_LEASE', 3600 ) )
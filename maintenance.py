@@ -0,0 +1,74 @@
+import logging
+import sys
+import threading
+import time
+import config
+import db
+from db import claimDbMaintenance, pruneDb
+
+LOG = logging.getLogger( 'wpr.maintenance' )
+
+maintenanceThread = None
+
+def setupLogging():
+    """Send maintenance reports to stderr, which gunicorn, systemd and cron all keep.
+       Left alone if the application has already configured the logger.
+    """
+    if LOG.handlers:
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter( logging.Formatter( '%(asctime)s %(name)s %(levelname)s: %(message)s' ) )
+
+    LOG.addHandler( handler )
+    LOG.setLevel( logging.INFO )
+
+def runMaintenance( force=False ):
+    """Prune wpr.db once if no other worker has done so within MAINTENANCE_INTERVAL,
+       or straight away with force.  Returns the prune report or None if the run was
+       skipped.
+    """
+
+    if not claimDbMaintenance( 0 if force else getattr( config, 'MAINTENANCE_INTERVAL', 3600 ) ):
+        return None
+
+    report = pruneDb( days=getattr( config, 'RETENTION_DAYS', None ),
+                      keep_jobs=getattr( config, 'RETENTION_JOBS', None ),
+                      history_days=getattr( config, 'HISTORY_RETENTION_DAYS', None ),
+                      batch=getattr( config, 'RETENTION_BATCH', 500 ) )
+
+    LOG.info( 'Pruned %d rows and reclaimed %d bytes from wpr.db', report['rows'], report['bytes'] )
+
+    return report
+
+def maintenanceLoop():
+    while True:
+        try:
+            runMaintenance()
+        except Exception:
+            LOG.exception( 'wpr.db maintenance failed' )
+
+        time.sleep( getattr( config, 'MAINTENANCE_INTERVAL', 3600 ) )
+
+def startMaintenance():
+    """Start the background maintenance thread for this process"""
+    global maintenanceThread
+
+    if maintenanceThread != None and maintenanceThread.is_alive():
+        return
+
+    setupLogging()
+
+    maintenanceThread = threading.Thread( target=maintenanceLoop, name='maintenance', daemon=True )
+    maintenanceThread.start()
+
+if __name__ == '__main__':
+    # Prune now, e.g. from cron, whatever MAINTENANCE_INTERVAL says
+    db.ownsDb = True
+    setupLogging()
+
+    try:
+        runMaintenance( force=True )
+    except Exception:
+        LOG.exception( 'wpr.db maintenance failed' )
+        sys.exit( 1 )
@@ -0,0 +1,152 @@
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+class Snapshot:
+    """A versioned job list shared by all gunicorn workers through a file.
+
+       Readers never lock.  A new version is written to a temporary file and
+       renamed over the old one, so a reader always sees a whole snapshot.
+       When the snapshot is older than max_age one worker takes the refresh
+       lock and rebuilds it while the others keep serving the old version, up
+       to stale_limit seconds old.  expire() takes the same lock so it can't
+       overwrite a snapshot being written.  build is called with no arguments
+       and must return something json can serialize.
+    """
+    def __init__(self, path, build, max_age=5, stale_limit=30):
+        self.path = path
+        self.build = build
+        self.max_age = max_age
+        self.stale_limit = stale_limit
+
+    def read(self):
+        """Load the current snapshot.  Returns None if there isn't one."""
+        try:
+            with open( self.path, 'r' ) as f:
+                return json.load( f )
+        except (OSError, ValueError):
+            return None
+
+    def write(self, data):
+        """Atomically replace the snapshot.  The version is the build time in
+           microseconds so it keeps increasing even after expire() removes the file.
+        """
+        snapshot = { 'version': time.time_ns() // 1000, 'created': time.time(), 'data': data }
+
+        self.store( snapshot )
+
+        return snapshot
+
+    def store(self, snapshot):
+        # A temporary file of our own, as threads in one worker can store at once
+        fd, tmp = tempfile.mkstemp( dir=os.path.dirname( self.path ) or '.', prefix=os.path.basename( self.path ) + '.' )
+
+        try:
+            with os.fdopen( fd, 'w' ) as f:
+                json.dump( snapshot, f )
+
+            os.replace( tmp, self.path )
+        except BaseException:
+            try:
+                os.remove( tmp )
+            except OSError:
+                pass
+
+            raise
+
+    def lock(self, blocking):
+        """Take the refresh lock.  Returns the descriptor to close to release it, or
+           None if another worker or thread holds it and blocking is False.
+        """
+        fd = os.open( self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600 )
+
+        try:
+            fcntl.flock( fd, fcntl.LOCK_EX | ( 0 if blocking else fcntl.LOCK_NB ) )
+        except BlockingIOError:
+            os.close( fd )
+            return None
+        except BaseException:
+            os.close( fd )
+            raise
+
+        return fd
+
+    def expire(self):
+        """Make the next read rebuild the snapshot.  The old data stays readable
+           until then so build can compare against it.
+        """
+        if self.read() == None:
+            return
+
+        try:
+            # Waits for a refresh in progress, which may have read CUPS before the change
+            fd = self.lock( blocking=True )
+        except OSError:
+            fd = None
+
+        try:
+            snapshot = self.read()
+
+            if snapshot == None:
+                return
+
+            snapshot['created'] = 0
+
+            try:
+                self.store( snapshot )
+            except OSError:
+                # Can't write it so throw it away instead
+                try:
+                    os.remove( self.path )
+                except OSError:
+                    pass
+        finally:
+            if fd != None:
+                os.close( fd )
+
+    def age(self, snapshot):
+        return time.time() - snapshot['created']
+
+    def refresh(self, blocking):
+        """Rebuild the snapshot if we win the refresh lock.  Returns None if we didn't."""
+        fd = self.lock( blocking )
+
+        if fd == None:
+            return None
+
+        try:
+            # Someone else may have finished a refresh while we waited
+            snapshot = self.read()
+
+            if snapshot and self.age( snapshot ) < self.max_age:
+                return snapshot
+
+            return self.write( self.build() )
+        finally:
+            os.close( fd )
+
+    def get(self):
+        """Get the current snapshot as {'version', 'created', 'data'}"""
+        snapshot = self.read()
+
+        if snapshot and self.age( snapshot ) < self.max_age:
+            return snapshot
+
+        try:
+            os.makedirs( os.path.dirname( self.path ), exist_ok=True )
+
+            fresh = self.refresh( blocking=False )
+
+            if fresh == None:
+                # Another worker is refreshing.  Serve what we have if it isn't too old.
+                if snapshot and self.age( snapshot ) < self.stale_limit:
+                    return snapshot
+
+                fresh = self.refresh( blocking=True )
+        except PermissionError:
+            # Snapshot directory not usable by this user so work alone
+            return { 'version': 0, 'created': time.time(), 'data': self.build() }
+
+        return fresh
@@ -0,0 +1,193 @@
+// Keeps the active job table current without reloading the page.  Changes are
+// pushed from /api/jobs/events when the browser can take server-sent events and
+// /api/jobs is polled as a fallback.  Rows are patched in place so ticked boxes survive.
+(function() {
+    var table = document.getElementById('jobs');
+    var tbody = table.tBodies[0];
+    var empty = document.getElementById('no-jobs');
+    var countdown = document.getElementById('countdown');
+
+    var version = table.dataset.version;
+    var etag = null;
+    var sort = table.dataset.sort;
+    var order = table.dataset.order;
+    var advanced = table.dataset.advanced > 0;
+    var interval = 10;
+    var live = false;
+
+    function esc(s) {
+        return String(s).replace(/[&<>"']/g, function(c) {
+            return { '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;' }[c];
+        });
+    }
+
+    function actionForm(action, jobId, label, style) {
+        return '<form action="/' + action + '_job/' + jobId + '" method="post">' +
+               '<input type="hidden" name="sort" value="' + esc(sort) + '">' +
+               '<input type="hidden" name="sort_order" value="' + esc(order) + '">' +
+               '<input type="submit" value="' + label + '" class="btn ' + style + '"></form>';
+    }
+
+    // Display strings come from the server's JobRecord so they match rendered rows
+    function cells(job) {
+        var text = job['display'];
+        var pages = job['page-count-pending'] ?
+            '<td class="align-middle text-muted">counting&hellip;</td>' :
+            job['page-count-failed'] ?
+            '<td class="align-middle text-muted">unknown</td>' :
+            '<td class="align-middle">' + esc(text['pages']) + '</td>';
+
+        return '<td class="align-middle text-center"><input type="checkbox" class="form-check-input job-select" name="job_id" value="' + job['job-id'] + '" form="bulk"></td>' +
+               '<td class="align-middle text-center"><a href="jobs/' + job['job-id'] + '" >' + job['job-id'] + '</a></td>' +
+               '<td class="align-middle">' + esc(text['user']) + '</td>' +
+               '<td class="align-middle">' + esc(text['name']) + '</td>' +
+               '<td class="align-middle">' + esc(text['queue']) + '</td>' +
+               '<td class="align-middle">' + esc(text['size']) + '</td>' +
+               pages +
+               '<td class="align-middle">' + esc(text['created']) + '</td>' +
+               '<td class="align-middle">' + esc(text['state']) + '</td>' +
+               '<td>' + actionForm('release', job['job-id'], 'Release', 'btn-success') +
+               (advanced ? '<br>' + actionForm('cancel', job['job-id'], 'Cancel', 'btn-danger') : '') + '</td>';
+    }
+
+    function findRow(jobId) {
+        return tbody.querySelector('tr[data-job-id="' + jobId + '"]');
+    }
+
+    function putJob(job) {
+        var row = findRow(job['job-id']);
+        var ticked = false;
+
+        if (row) {
+            ticked = row.querySelector('.job-select').checked;
+        } else {
+            row = document.createElement('tr');
+            row.dataset.jobId = job['job-id'];
+            tbody.appendChild(row);
+        }
+
+        row.innerHTML = cells(job);
+        row.querySelector('.job-select').checked = ticked;
+        row.dataset.key = JSON.stringify(job['keys'][sort] || job['keys']['job-originating-user-name']);
+    }
+
+    function removeJob(jobId) {
+        var row = findRow(jobId);
+
+        if (row) {
+            tbody.removeChild(row);
+        }
+    }
+
+    function resort() {
+        var rows = Array.prototype.slice.call(tbody.rows);
+
+        // Keys are [kind, value] pairs from the server, compared the way JobList sorts
+        // them with the job id breaking ties
+        rows.sort(function(a, b) {
+            var x = JSON.parse(a.dataset.key);
+            var y = JSON.parse(b.dataset.key);
+            var c = x[0] - y[0] || (x[1] < y[1] ? -1 : x[1] > y[1] ? 1 : 0) || a.dataset.jobId - b.dataset.jobId;
+            return order == 'desc' ? -c : c;
+        });
+
+        for (var i = 0; i < rows.length; i++) {
+            tbody.appendChild(rows[i]);
+        }
+
+        empty.hidden = rows.length > 0;
+    }
+
+    function apply(data) {
+        if (data.full) {
+            var keep = {};
+
+            data.jobs.forEach(function(job) { keep[job['job-id']] = true; putJob(job); });
+
+            Array.prototype.slice.call(tbody.rows).forEach(function(row) {
+                if (!keep[row.dataset.jobId]) {
+                    tbody.removeChild(row);
+                }
+            });
+        } else {
+            data.added.forEach(putJob);
+            data.changed.forEach(putJob);
+            data.removed.forEach(removeJob);
+        }
+
+        version = data.version;
+        resort();
+    }
+
+    function refresh() {
+        var headers = etag ? { 'If-None-Match': etag } : {};
+
+        return fetch('/api/jobs?since=' + encodeURIComponent(version), { headers: headers, cache: 'no-store' })
+            .then(function(response) {
+                if (response.redirected) {
+                    // Logged out
+                    location.reload();
+                } else if (response.status == 200) {
+                    etag = response.headers.get('ETag');
+                    return response.json().then(apply);
+                }
+            })
+            .catch(function() {});
+    }
+
+    document.getElementById('select-all').addEventListener('change', function() {
+        var boxes = document.querySelectorAll('.job-select');
+        for (var i = 0; i < boxes.length; i++) {
+            boxes[i].checked = this.checked;
+        }
+    });
+
+    function pushed(handler) {
+        return function(e) {
+            handler(JSON.parse(e.data));
+
+            if (e.lastEventId) {
+                version = e.lastEventId;
+            }
+
+            resort();
+        };
+    }
+
+    if (window.EventSource && table.dataset.events > 0) {
+        var source = new EventSource('/api/jobs/events?since=' + encodeURIComponent(version));
+
+        source.addEventListener('open', function() { live = true; });
+        source.addEventListener('error', function() { live = false; });
+        source.addEventListener('job-added', pushed(putJob));
+        source.addEventListener('job-state-changed', pushed(putJob));
+        source.addEventListener('job-removed', pushed(removeJob));
+        source.addEventListener('reset', function(e) {
+            var data = JSON.parse(e.data);
+            data.full = true;
+            apply(data);
+        });
+    }
+
+    (function tick(remaining) {
+        if (live) {
+            // Nothing to count down to while changes are pushed
+            countdown.innerHTML = '<i class="fa fa-refresh me-1"></i> Live';
+            setTimeout(function() { tick(interval); }, 1000);
+            return;
+        }
+
+        countdown.innerHTML = '<i class="fa fa-refresh me-1"></i> Refresh list in ' + remaining + ' seconds';
+
+        if (remaining <= 0) {
+            refresh().then(function() { tick(interval); });
+        } else {
+            setTimeout(function() { tick(remaining - 1); }, 1000);
+        }
+    })(interval);
+
+    if (advanced) {
+        // Advanced mode lapses on the server after 5 minutes
+        setTimeout(function() { location.reload(); }, 5 * 60 * 1000);
+    }
+})();
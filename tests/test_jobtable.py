@@ -0,0 +1,91 @@
+"""JobTable against a fake CUPS connection.
+
+   python3 -m unittest discover tests
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+from jobtable import JobTable
+
+class FakeConnection:
+    """The pycups Connection methods JobTable uses, backed by a dict of jobs.
+       fail holds job ids whose getJobAttributes raises RuntimeError once.
+    """
+    def __init__(self):
+        self.jobs = {}
+        self.events = []
+        self.fail = set()
+        self.listings = 0
+
+    def add(self, job_id, state=4):
+        self.jobs[job_id] = { 'job-state': state, 'job-name': 'job ' + str( job_id ) }
+        self.events.append( { 'notify-sequence-number': len( self.events ) + 1,
+                              'notify-subscribed-event': 'job-created',
+                              'notify-job-id': job_id,
+                              'job-state': state } )
+
+    def createSubscription(self, uri, events=None, lease_duration=None):
+        return 1
+
+    def renewSubscription(self, subscription, lease_duration=None):
+        pass
+
+    def getNotifications(self, subscriptions, sequence_numbers=None):
+        return { 'events': [ e for e in self.events if e['notify-sequence-number'] >= sequence_numbers[0] ] }
+
+    def getJobs(self, **kwargs):
+        self.listings += 1
+
+        return { k: dict( v ) for k, v in self.jobs.items() }
+
+    def getJobAttributes(self, job_id, requested_attributes=None):
+        if job_id in self.fail:
+            self.fail.discard( job_id )
+            raise RuntimeError( 'connection reset' )
+
+        return dict( self.jobs[job_id] )
+
+class JobTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection()
+        self.table = JobTable( conn=self.conn, interval=0 )
+
+        self.conn.add( 1 )
+        self.assertEqual( list( self.table.getJobs() ), [ 1 ] )
+
+    def testNewJob(self):
+        self.conn.add( 2 )
+
+        self.assertEqual( sorted( self.table.getJobs() ), [ 1, 2 ] )
+        self.assertEqual( self.conn.listings, 1 )
+
+    def testRefreshFailure(self):
+        self.conn.add( 2 )
+        self.conn.fail.add( 2 )
+
+        with self.assertRaises( RuntimeError ):
+            self.table.getJobs()
+
+        # The failed update isn't lost
+        self.assertEqual( sorted( self.table.getJobs() ), [ 1, 2 ] )
+
+        # and events after it still apply
+        self.conn.add( 3 )
+        self.assertEqual( sorted( self.table.getJobs() ), [ 1, 2, 3 ] )
+
+    def testPeriodicResync(self):
+        # A job CUPS never sent an event for
+        self.conn.jobs[5] = { 'job-state': 4 }
+
+        self.assertEqual( sorted( self.table.getJobs() ), [ 1 ] )
+
+        self.table.resyncAt = time.monotonic()
+        self.assertEqual( sorted( self.table.getJobs() ), [ 1, 5 ] )
+
+if __name__ == '__main__':
+    unittest.main()
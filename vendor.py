@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Download the third party CSS, JavaScript and fonts into static/vendor so pages
+   don't depend on a CDN.  Run again after changing the versions in assets.py.
+"""
+import os
+import sys
+import urllib.request
+from assets import cdnBase, vendorAssets, vendorFiles
+
+def main():
+    static = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'static' )
+    failed = 0
+
+    for filename, source in sorted( { **vendorAssets, **vendorFiles }.items() ):
+        path = os.path.join( static, filename )
+        os.makedirs( os.path.dirname( path ), exist_ok=True )
+
+        try:
+            with urllib.request.urlopen( cdnBase + source, timeout=30 ) as r:
+                data = r.read()
+        except OSError as e:
+            print( 'Error: ' + source + ': ' + repr(e) )
+            failed += 1
+            continue
+
+        # Write then rename so a half downloaded file is never served
+        with open( path + '.tmp', 'wb' ) as f:
+            f.write( data )
+
+        os.replace( path + '.tmp', path )
+
+        print( filename + ' ' + str( len( data ) ) + ' bytes' )
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit( main() )